@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the scrapop pipeline against local stand-ins for AWIS and Sheets.
+
+Usage:
+    python benchmarks/bench_core.py --rows 20000 --concurrency 8 --latency 0.05
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from scrapop.core import extract_targets
+from scrapop.fetch import MetricsFetcher
+from scrapop.stats import Stats
+from scrapop.throttle import AdaptiveBatcher
+from scrapop.utils import GssUtils, AwisUtils, UrlUtils
+
+from stub_servers import AwisStubServer, SheetsStubServer, StubCredentials
+
+METRIC_NAMES = ['Rank', 'LinksInCount', 'Speed']
+
+
+def make_cells(rows, unique_ratio):
+    """Make a target column with a mix of plain and hyperlinked domains."""
+    unique = max(1, int(rows * unique_ratio))
+    cells = []
+    for index in range(rows):
+        domain = 'site%d.com' % random.randrange(unique)
+        choice = index % 10
+        if choice == 0:
+            cells.append(None)
+        elif choice < 4:
+            cells.append('=HYPERLINK("http://www.alexa.com/siteinfo/%s", "%s")' % (domain, domain))
+        else:
+            cells.append('www.%s' % domain)
+    return cells
+
+
+def percentile(values, fraction):
+    """The value at a fraction of the way through the sorted values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(args):
+    """Run the pipeline once, returning a dict of results."""
+    random.seed(args.seed)
+    sheets = SheetsStubServer(make_cells(args.rows, args.unique_ratio), latency=args.sheets_latency)
+    awis = AwisStubServer(args.latency, args.error_rate, args.invalid_rate)
+    sheets.start()
+    awis.start()
+    credential_dir = tempfile.mkdtemp()
+    try:
+        GssUtils.credential_dir = credential_dir
+        GssUtils.discovery_url = sheets.discovery_url
+        GssUtils.use_credentials(StubCredentials())
+        AwisUtils.configure('stub-key', 'stub-secret', host=awis.host)
+        options = argparse.Namespace()
+
+        stages = {}
+        start = time.time()
+        cells = GssUtils.iter_column(
+            'stub', 'Sheet1', 'A', value_render='FORMULA', options=options,
+            window=args.read_window, concurrency=args.read_concurrency
+        )
+        unique_domains, cell_info = extract_targets(cells)
+        stages['read_extract'] = time.time() - start
+
+        start = time.time()
+        fetcher = MetricsFetcher(
+            METRIC_NAMES,
+            concurrency=args.concurrency,
+            batcher=AdaptiveBatcher(args.chunk_size, target_latency=args.target_latency),
+            backoff_base=0.01
+        )
+        metrics = fetcher.fetch(unique_domains)
+        stages['fetch'] = time.time() - start
+
+        start = time.time()
+        rows = {}
+        metric_ids = metrics.get_ids(UrlUtils.only_domains(cell_info.domains.names))
+        for row, domain_id in zip(cell_info.rows, cell_info.domain_ids):
+            if domain_id >= 0 and metric_ids[domain_id] >= 0:
+                rows[row] = metrics.get_values(metric_ids[domain_id])
+        written = GssUtils.update_rows('stub', 'Sheet1', 'B', rows, options=options)
+        stages['write_back'] = time.time() - start
+
+        return {
+            'rows': args.rows,
+            'unique_domains': len(unique_domains),
+            'fetched_domains': fetcher.fetched_count,
+            'failed_domains': len(fetcher.errors),
+            'awis_requests': awis.request_count,
+            'domains_per_sec': fetcher.domains_per_sec,
+            'chunk_latency_p50': percentile(fetcher.latencies, 0.5),
+            'chunk_latency_p99': percentile(fetcher.latencies, 0.99),
+            'cells_written': written,
+            'update_requests': sheets.update_requests,
+            'stages': stages,
+            'counters': Stats.to_dict()['counters'],
+            # kilobytes on linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        awis.stop()
+        sheets.stop()
+        shutil.rmtree(credential_dir, ignore_errors=True)
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results."""
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--rows', type=int, default=5000)
+    argparser.add_argument('--unique-ratio', type=float, default=0.5,
+                           help='Fraction of rows with a distinct domain')
+    argparser.add_argument('--chunk-size', type=int, default=AwisUtils.max_batch_size)
+    argparser.add_argument('--concurrency', type=int, default=4)
+    argparser.add_argument('--target-latency', type=float, default=5.0)
+    argparser.add_argument('--latency', type=float, default=0.02,
+                           help='Mean AWIS response latency in seconds')
+    argparser.add_argument('--error-rate', type=float, default=0.0,
+                           help='Fraction of AWIS requests answered with a 503')
+    argparser.add_argument('--invalid-rate', type=float, default=0.0,
+                           help='Fraction of domains AWIS has no metrics for')
+    argparser.add_argument('--sheets-latency', type=float, default=0.0)
+    argparser.add_argument('--read-window', type=int, default=5000)
+    argparser.add_argument('--read-concurrency', type=int, default=1)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = argparser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("rows: %(rows)d, unique domains: %(unique_domains)d" % results)
+    print("fetched: %(fetched_domains)d, failed: %(failed_domains)d, "
+          "awis requests: %(awis_requests)d" % results)
+    print("domains/sec: %(domains_per_sec).1f" % results)
+    print("chunk latency p50: %.1fms, p99: %.1fms" % (
+        results['chunk_latency_p50'] * 1000, results['chunk_latency_p99'] * 1000
+    ))
+    print("cells written: %(cells_written)d in %(update_requests)d requests" % results)
+    for stage, seconds in sorted(results['stages'].items()):
+        print("%s: %.2fs" % (stage, seconds))
+    print("peak rss: %.1f MiB" % (results['peak_rss_kb'] / 1024.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark how long `python -m scrapop.core --help` takes, failing over budget.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 10 --budget 0.5
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# modules which should only be imported once they are needed
+HEAVY_MODULES = [
+    'httplib2', 'apiclient', 'googleapiclient', 'oauth2client', 'tldextract',
+    'awis', 'lxml', 'tabulate', 'numpy', 'pyarrow',
+]
+
+CHECK_IMPORTS = """\
+import json, sys
+import scrapop.core
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules) & set(%r))))
+"""
+
+
+def time_help(runs):
+    """Run the help command several times, returning the wall time of each."""
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(
+                [sys.executable, '-m', 'scrapop.core', '--help'],
+                cwd=ROOT, stdout=devnull
+            )
+            timings.append(time.time() - start)
+    return timings
+
+
+def heavy_imports():
+    """Get the heavy modules which importing scrapop.core pulls in."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHECK_IMPORTS % HEAVY_MODULES], cwd=ROOT
+    )
+    return json.loads(output)
+
+
+def main():
+    """Time the help command and check it against the budget."""
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--runs', type=int, default=10)
+    argparser.add_argument('--budget', type=float, default=0.5,
+                           help='Maximum median seconds for --help')
+    argparser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = argparser.parse_args()
+
+    timings = sorted(time_help(args.runs))
+    results = {
+        'runs': args.runs,
+        'median': timings[len(timings) // 2],
+        'min': timings[0],
+        'max': timings[-1],
+        'budget': args.budget,
+        'heavy_imports': heavy_imports(),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("--help median: %(median).3fs, min: %(min).3fs, max: %(max).3fs, "
+              "budget: %(budget).3fs" % results)
+        print("heavy modules imported: %s" % (', '.join(results['heavy_imports']) or 'none'))
+    if results['median'] > args.budget or results['heavy_imports']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the AWIS and Google Sheets APIs, for benchmarking.
+"""
+
+from __future__ import print_function
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from urlparse import urlsplit, parse_qs, unquote
+
+AWIS_NS = "http://awis.amazonaws.com/doc/2005-07-11"
+ALEXA_NS = "http://alexa.amazonaws.com/doc/2005-10-05/"
+
+
+class StubHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server which runs in the background."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.thread = None
+
+    @property
+    def host(self):
+        """The host:port the server is listening on."""
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        """Serve requests on a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests."""
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive request handler with a helper for sending bodies."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status, body, content_type='application/json'):
+        """Send a complete response."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AwisStubHandler(StubHandler):
+    """Answers UrlInfo requests with made up metrics."""
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_body(503, 'Service Unavailable', 'text/plain')
+            return
+
+        query = parse_qs(urlsplit(self.path).query)
+        response_groups = query.get('UrlInfo.Shared.ResponseGroup', [''])[0].split(',')
+        urls = []
+        index = 1
+        while 'UrlInfo.%d.Url' % index in query:
+            urls.append(unquote(query['UrlInfo.%d.Url' % index][0]))
+            index += 1
+
+        with server.lock:
+            server.request_count += 1
+            server.domain_count += len(urls)
+        responses = ''.join(server.url_info_response(url, response_groups) for url in urls)
+        self.send_body(200, (
+            '<?xml version="1.0"?>'
+            '<aws:UrlInfoResponse xmlns:aws="%s">%s</aws:UrlInfoResponse>'
+        ) % (ALEXA_NS, responses), 'text/xml')
+
+
+class AwisStubServer(StubHTTPServer):
+    """
+    Stand-in for the AWIS UrlInfo action.
+
+    Args:
+        latency (float): Mean seconds to wait before answering.
+        error_rate (float): Fraction of requests answered with a 503.
+        invalid_rate (float): Fraction of domains which always come back with
+            an error status.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, invalid_rate=0.0):
+        StubHTTPServer.__init__(self, AwisStubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.domain_count = 0
+
+    def is_invalid(self, url):
+        """Whether a domain consistently fails, decided by its hash."""
+        return (zlib.crc32(url) & 0xffff) < self.invalid_rate * 0x10000
+
+    def url_info_response(self, url, response_groups):
+        """Build the Response element for a single domain."""
+        if self.is_invalid(url):
+            return (
+                '<aws:Response xmlns:aws="%s">'
+                '<aws:ResponseStatus xmlns:aws="%s"><aws:StatusCode>AlexaError</aws:StatusCode>'
+                '</aws:ResponseStatus></aws:Response>'
+            ) % (AWIS_NS, ALEXA_NS)
+        seed = zlib.crc32(url) & 0xffffff
+        values = {
+            'Rank': '<aws:Rank>%d</aws:Rank>' % (seed % 1000000 + 1),
+            'LinksInCount': '<aws:LinksInCount>%d</aws:LinksInCount>' % (seed % 5000),
+            'Speed': (
+                '<aws:Speed><aws:MedianLoadTime>%d</aws:MedianLoadTime>'
+                '<aws:Percentile>%d</aws:Percentile></aws:Speed>'
+            ) % (seed % 3000, seed % 100),
+        }
+        return (
+            '<aws:Response xmlns:aws="%s">'
+            '<aws:OperationRequest><aws:RequestId>stub</aws:RequestId></aws:OperationRequest>'
+            '<aws:UrlInfoResult><aws:Alexa><aws:ContentData>'
+            '<aws:DataUrl type="canonical">%s/</aws:DataUrl>%s'
+            '</aws:ContentData></aws:Alexa></aws:UrlInfoResult>'
+            '<aws:ResponseStatus xmlns:aws="%s"><aws:StatusCode>Success</aws:StatusCode>'
+            '</aws:ResponseStatus></aws:Response>'
+        ) % (
+            AWIS_NS, url,
+            ''.join(values.get(group, '') for group in response_groups),
+            ALEXA_NS
+        )
+
+
+class SheetsStubHandler(StubHandler):
+    """Answers the subset of the Sheets API used by GssUtils."""
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        query = parse_qs(parts.query)
+
+        if path == '/$discovery/rest':
+            self.send_body(200, json.dumps(server.discovery_doc()))
+            return
+
+        match = re.match(r'/v4/spreadsheets/([^/]+)/values:batchGet$', path)
+        if match:
+            self.send_body(200, json.dumps({
+                'spreadsheetId': match.group(1),
+                'valueRanges': [
+                    {'range': range_name, 'values': server.get_values(range_name)} \
+                    for range_name in query.get('ranges', [])
+                ],
+            }))
+            return
+
+        match = re.match(r'/v4/spreadsheets/([^/]+)/values/(.+)$', path)
+        if match:
+            self.send_body(200, json.dumps({
+                'range': match.group(2),
+                'values': server.get_values(match.group(2)),
+            }))
+            return
+
+        match = re.match(r'/v4/spreadsheets/([^/]+)$', path)
+        if match:
+            self.send_body(200, json.dumps({'sheets': [{
+                'properties': {'gridProperties': {'rowCount': server.row_count}}
+            }]}))
+            return
+
+        self.send_body(404, json.dumps({'error': {'code': 404, 'message': path}}))
+
+    def do_POST(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        if urlsplit(self.path).path.endswith('values:batchUpdate'):
+            updated = 0
+            for value_range in body.get('data', []):
+                updated += server.set_values(value_range['range'], value_range['values'])
+            with server.lock:
+                server.update_requests += 1
+                server.updated_cells += updated
+            self.send_body(200, json.dumps({'totalUpdatedCells': updated}))
+            return
+        self.send_body(404, json.dumps({'error': {'code': 404, 'message': self.path}}))
+
+
+class SheetsStubServer(StubHTTPServer):
+    """
+    Stand-in for the Sheets API values.get, values.batchGet and
+    values.batchUpdate methods, backed by an in-memory grid.
+
+    Args:
+        cells (list): Values of the first column, starting at row 1.
+        latency (float): Seconds to wait before answering.
+    """
+
+    re_range = re.compile(
+        r"^(?:'?(?P<sheet>[^'!]*)'?!)?(?P<start_col>[A-Z]+)(?P<start_row>\d*)"
+        r"(?::(?P<end_col>[A-Z]+)(?P<end_row>\d*))?$"
+    )
+
+    def __init__(self, cells, latency=0.0):
+        StubHTTPServer.__init__(self, SheetsStubHandler)
+        self.grid = {}
+        for row, cell in enumerate(cells, 1):
+            if cell is not None:
+                self.grid[(row, 0)] = cell
+        self.row_count = max(len(cells), 1000)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.update_requests = 0
+        self.updated_cells = 0
+
+    @property
+    def discovery_url(self):
+        """Where GssUtils should fetch the discovery document from."""
+        return 'http://%s/$discovery/rest?version=v4' % self.host
+
+    def discovery_doc(self):
+        """A discovery document covering the methods GssUtils uses."""
+        path_param = {'type': 'string', 'required': True, 'location': 'path'}
+        query_param = {'type': 'string', 'location': 'query'}
+        repeated_param = {'type': 'string', 'location': 'query', 'repeated': True}
+        return {
+            'kind': 'discovery#restDescription',
+            'name': 'sheets',
+            'version': 'v4',
+            'rootUrl': 'http://%s/' % self.host,
+            'servicePath': '',
+            'baseUrl': 'http://%s/' % self.host,
+            'batchPath': 'batch',
+            'parameters': {
+                'alt': {'type': 'string', 'location': 'query', 'default': 'json'},
+                'fields': query_param,
+            },
+            'schemas': dict(
+                (name, {'id': name, 'type': 'object'}) for name in [
+                    'Spreadsheet', 'ValueRange', 'BatchGetValuesResponse',
+                    'BatchUpdateValuesRequest', 'BatchUpdateValuesResponse',
+                ]
+            ),
+            'resources': {'spreadsheets': {
+                'methods': {'get': {
+                    'id': 'sheets.spreadsheets.get',
+                    'path': 'v4/spreadsheets/{spreadsheetId}',
+                    'httpMethod': 'GET',
+                    'parameters': {'spreadsheetId': path_param, 'ranges': repeated_param},
+                    'parameterOrder': ['spreadsheetId'],
+                    'response': {'$ref': 'Spreadsheet'},
+                }},
+                'resources': {'values': {'methods': {
+                    'get': {
+                        'id': 'sheets.spreadsheets.values.get',
+                        'path': 'v4/spreadsheets/{spreadsheetId}/values/{range}',
+                        'httpMethod': 'GET',
+                        'parameters': {
+                            'spreadsheetId': path_param,
+                            'range': path_param,
+                            'valueRenderOption': query_param,
+                        },
+                        'parameterOrder': ['spreadsheetId', 'range'],
+                        'response': {'$ref': 'ValueRange'},
+                    },
+                    'batchGet': {
+                        'id': 'sheets.spreadsheets.values.batchGet',
+                        'path': 'v4/spreadsheets/{spreadsheetId}/values:batchGet',
+                        'httpMethod': 'GET',
+                        'parameters': {
+                            'spreadsheetId': path_param,
+                            'ranges': repeated_param,
+                            'valueRenderOption': query_param,
+                        },
+                        'parameterOrder': ['spreadsheetId'],
+                        'response': {'$ref': 'BatchGetValuesResponse'},
+                    },
+                    'batchUpdate': {
+                        'id': 'sheets.spreadsheets.values.batchUpdate',
+                        'path': 'v4/spreadsheets/{spreadsheetId}/values:batchUpdate',
+                        'httpMethod': 'POST',
+                        'parameters': {'spreadsheetId': path_param},
+                        'parameterOrder': ['spreadsheetId'],
+                        'request': {'$ref': 'BatchUpdateValuesRequest'},
+                        'response': {'$ref': 'BatchUpdateValuesResponse'},
+                    },
+                }}},
+            }},
+        }
+
+    @classmethod
+    def column_index(cls, letters):
+        """Convert column letters to a zero based index."""
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - ord('A') + 1
+        return index - 1
+
+    def parse_range(self, range_name):
+        """Get the first and last (row, column) of an A1 range."""
+        match = self.re_range.match(range_name)
+        if not match:
+            raise ValueError('unsupported range %s' % range_name)
+        start_col = self.column_index(match.group('start_col'))
+        end_col = self.column_index(match.group('end_col') or match.group('start_col'))
+        start_row = int(match.group('start_row') or 1)
+        end_row = int(match.group('end_row') or self.row_count)
+        return (start_row, start_col), (end_row, end_col)
+
+    def get_values(self, range_name):
+        """Values of a range, with trailing empty rows and cells left out."""
+        (start_row, start_col), (end_row, end_col) = self.parse_range(range_name)
+        rows = []
+        with self.lock:
+            for row in range(start_row, end_row + 1):
+                values = [self.grid.get((row, col)) for col in range(start_col, end_col + 1)]
+                while values and values[-1] is None:
+                    values.pop()
+                rows.append(['' if value is None else value for value in values])
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def set_values(self, range_name, values):
+        """Write values into the grid, returning the number of cells written."""
+        (start_row, start_col), _ = self.parse_range(range_name)
+        count = 0
+        with self.lock:
+            for row_offset, row_values in enumerate(values):
+                for col_offset, value in enumerate(row_values):
+                    self.grid[(start_row + row_offset, start_col + col_offset)] = value
+                    count += 1
+        return count
+
+
+class StubCredentials(object):
+    """Credentials which never expire and leave requests unsigned."""
+
+    invalid = False
+    token_expiry = None
+
+    def authorize(self, http):
+        """Return the http object unchanged."""
+        return http
@@ -2,23 +2,73 @@
 """scrapes rank from Alexa."""
 
 from collections import OrderedDict
+import sys
+import os
 import scrapy
 from scrapy.crawler import CrawlerProcess
 import configargparse
 import argparse
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from scrapop.core import extract_targets
+from scrapop.utils import GssUtils, UrlUtils
+
 from spiders import metrics as metric_spiders
 
 METRIC_SPIDERS = OrderedDict([
     ('alexa', metric_spiders.AlexaSpider),
 ])
 
+# Settings shared by every crawl. Domain crawls go through a single host per
+# spider, so CONCURRENT_REQUESTS_PER_DOMAIN is what actually bounds the load,
+# and AutoThrottle backs off from there when the host slows down.
+CRAWLER_SETTINGS = {
+    'ITEM_PIPELINES':{
+        'pipelines.DedupPipeline': 50,
+        'pipelines.JsonWriterPipeline': 100
+    },
+    'CONCURRENT_REQUESTS': 32,
+    'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    'AUTOTHROTTLE_ENABLED': True,
+    'AUTOTHROTTLE_START_DELAY': 1.0,
+    'AUTOTHROTTLE_MAX_DELAY': 30.0,
+    'AUTOTHROTTLE_TARGET_CONCURRENCY': 4.0,
+    'DOWNLOAD_TIMEOUT': 30,
+    'RETRY_TIMES': 2,
+    'COOKIES_ENABLED': False,
+    'DNSCACHE_ENABLED': True,
+    'LOG_LEVEL': 'INFO',
+    # pages are kept and revalidated, spiders set HTTPCACHE_FRESHNESS_SECS
+    'DOWNLOADER_MIDDLEWARES': {
+        'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+        'httpcache.RevalidatingCacheMiddleware': 900,
+    },
+    'HTTPCACHE_ENABLED': True,
+    'HTTPCACHE_POLICY': 'httpcache.FreshnessPolicy',
+    'HTTPCACHE_STORAGE': 'httpcache.SqliteCacheStorage',
+    'HTTPCACHE_DIR': 'httpcache',
+    # store pages without validators too, the freshness window still applies,
+    # FreshnessPolicy only stores 200 responses
+    'HTTPCACHE_ALWAYS_STORE': True,
+    'METRICS_OUTPUT_PATH': 'items.jl',
+    'METRICS_OUTPUT_BUFFER_BYTES': 1024 * 1024,
+    'METRICS_DEDUP_BUCKET_SECS': 60 * 60,
+    'METRICS_DEDUP_MAX_KEYS': 100000,
+}
+
 
 def main():
-    """Main function for scraping a single metric from a url."""
+    """Main function for scraping metrics from a url, or a list of domains."""
 
     argparser = configargparse.ArgumentParser(
-        description="Scrape and store popularity metrics"
+        description="Scrape and store popularity metrics",
+        parents=[GssUtils.get_flags_parser()]
+    )
+
+    argparser.add_argument(
+        '-c', '--my-config',
+        is_config_file=True,
+        help='config file path'
     )
 
     argparser.add_argument(
@@ -27,42 +77,196 @@ def main():
         default=METRIC_SPIDERS.keys()[0]
     )
 
-    argparser.add_argument('--url', required=True)
-
     argparser.add_argument('--spider-args', help=argparse.SUPPRESS)
 
-    spider_name = None
-    crawl_url = None
-    spider_args = None
-    crawler_settings = None
+    target_group = argparser.add_argument_group('Target Options')
+    target_group.add_argument(
+        '--url',
+        help='Scrape a single url'
+    )
+    target_group.add_argument(
+        '--domains-file',
+        help='Scrape every domain in this file, one target cell per line',
+        metavar='FILE'
+    )
+    target_group.add_argument(
+        '--file-id',
+        help='Scrape every domain in the target column of this spreadsheet',
+        metavar='ID'
+    )
+    target_group.add_argument(
+        '--target-sheet',
+        help='The name of the sheet containing popularity data',
+        default='Sheet1',
+        metavar='SHEET'
+    )
+    target_group.add_argument(
+        '--target-column',
+        help='The column containing the target site name',
+        default='A',
+        metavar='COL'
+    )
+    target_group.add_argument(
+        '--client-secret-file',
+        help='Location of file containing Google Drive Auth info',
+        default='./client_secret.json',
+        metavar='FILE'
+    )
+
+    output_group = argparser.add_argument_group('Output Options')
+    output_group.add_argument(
+        '-o', '--out-file',
+        help='File to append scraped metrics to, %%(name)s is the spider name',
+        default=CRAWLER_SETTINGS['METRICS_OUTPUT_PATH'],
+        metavar='FILE'
+    )
+    output_group.add_argument(
+        '--out-compress',
+        choices=['gzip', 'zstd'],
+        help='Compress the output file'
+    )
+    output_group.add_argument(
+        '--rotate-bytes',
+        type=int,
+        help='Start a new output file after this many bytes',
+        default=0,
+        metavar='BYTES'
+    )
+    output_group.add_argument(
+        '--rotate-secs',
+        type=int,
+        help='Start a new output file after this many seconds',
+        default=0,
+        metavar='SECONDS'
+    )
+
+    crawl_group = argparser.add_argument_group('Crawl Options')
+    crawl_group.add_argument(
+        '--concurrent-requests',
+        type=int,
+        help='Maximum requests in flight across the whole crawl',
+        default=CRAWLER_SETTINGS['CONCURRENT_REQUESTS'],
+        metavar='N'
+    )
+    crawl_group.add_argument(
+        '--concurrent-requests-per-domain',
+        type=int,
+        help='Maximum requests in flight to any one host',
+        default=CRAWLER_SETTINGS['CONCURRENT_REQUESTS_PER_DOMAIN'],
+        metavar='N'
+    )
+    crawl_group.add_argument(
+        '--autothrottle-target',
+        type=float,
+        help='Average requests in flight per host that AutoThrottle aims for',
+        default=CRAWLER_SETTINGS['AUTOTHROTTLE_TARGET_CONCURRENCY'],
+        metavar='N'
+    )
+    crawl_group.add_argument(
+        '--no-autothrottle',
+        action='store_true',
+        help='Crawl at the fixed concurrency limits'
+    )
+    crawl_group.add_argument(
+        '--http-cache-dir',
+        help='Where to keep cached pages, relative to the .scrapy directory',
+        default=CRAWLER_SETTINGS['HTTPCACHE_DIR'],
+        metavar='DIR'
+    )
+    crawl_group.add_argument(
+        '--no-http-cache',
+        action='store_true',
+        help='Always download pages in full'
+    )
 
     args = argparser.parse_args()
-    if args:
-        if args.spider_name:
-            spider_name = args.spider_name
-        if args.url:
-            crawl_url = args.url
 
-    scrape_metric(crawl_url, spider_name, spider_args, crawler_settings)
+    spider_name = args.spider_name
+    spider_args = None
+    crawler_settings = {
+        'CONCURRENT_REQUESTS': args.concurrent_requests,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrent_requests_per_domain,
+        'AUTOTHROTTLE_ENABLED': not args.no_autothrottle,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': args.autothrottle_target,
+        'HTTPCACHE_ENABLED': not args.no_http_cache,
+        'HTTPCACHE_DIR': args.http_cache_dir,
+        'METRICS_OUTPUT_PATH': args.out_file,
+        'METRICS_OUTPUT_COMPRESS': args.out_compress,
+        'METRICS_OUTPUT_ROTATE_BYTES': args.rotate_bytes,
+        'METRICS_OUTPUT_ROTATE_SECS': args.rotate_secs,
+    }
+
+    if args.url:
+        scrape_metric(args.url, spider_name, spider_args, crawler_settings)
+        return
+
+    if args.domains_file:
+        with open(args.domains_file) as domains_handle:
+            target_cells = [[line.strip().decode('utf-8')] for line in domains_handle]
+    elif args.file_id:
+        args.scopes = 'https://www.googleapis.com/auth/spreadsheets'
+        args.app_name = 'ScraPop'
+        target_cells = GssUtils.iter_column(
+            args.file_id,
+            args.target_sheet,
+            args.target_column,
+            value_render='FORMULA',
+            options=args
+        )
+    else:
+        argparser.error('one of --url, --domains-file or --file-id is required')
+
+    unique_domains, _ = extract_targets(target_cells)
+    scrape_metrics(unique_domains, spider_name, spider_args, crawler_settings)
+
+
+def get_crawler_settings(crawler_settings=None):
+    """Get the default crawler settings, overridden by crawler_settings."""
+
+    settings = dict(CRAWLER_SETTINGS)
+    if crawler_settings:
+        settings.update(crawler_settings)
+    return settings
+
+
+def get_spider_class(spider_name=None):
+    """Get the spider class registered as spider_name, or the default spider."""
+
+    if spider_name is not None:
+        return METRIC_SPIDERS[spider_name]
+    return METRIC_SPIDERS.values()[0]
 
 
 def scrape_metric(url, spider_name=None, spider_args=None, crawler_settings=None):
     """Scraping a single metric from a url."""
 
-    spider_args = {
-        'start_url':url
-    }
-    crawler_settings = {
-        'ITEM_PIPELINES':{
-            'scrapop.pipelines.JsonWriterPipeline': 100
-        }
-    }
-    spider_class = METRIC_SPIDERS.values()[0]
-    if spider_name is not None:
-        spider_class = METRIC_SPIDERS[spider_name]
+    spider_args = dict(spider_args or {})
+    spider_args.update(start_url=url)
+
+    process = CrawlerProcess(get_crawler_settings(crawler_settings))
+    process.crawl(get_spider_class(spider_name), **spider_args)
+    process.start()
+
+
+def scrape_metrics(domains, spider_name=None, spider_args=None, crawler_settings=None):
+    """
+    Scrape a metric for every domain in a single crawl.
+
+    Args:
+        domains (list): The domains to scrape, e.g. from extract_targets.
+        spider_name (basestring): One of METRIC_SPIDERS.
+        spider_args (dict): Extra arguments for the spider.
+        crawler_settings (dict): Scrapy settings overriding CRAWLER_SETTINGS.
+    """
+
+    domains = list(OrderedDict.fromkeys(
+        domain for domain in UrlUtils.only_domains(domains) if domain
+    ))
+    spider_args = dict(spider_args or {})
+    spider_args.update(domains=domains)
 
-    process = CrawlerProcess(crawler_settings)
-    process.crawl(spider_class, **spider_args)
+    process = CrawlerProcess(get_crawler_settings(crawler_settings))
+    process.crawl(get_spider_class(spider_name), **spider_args)
     process.start()
 
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Scrapy HTTP cache middleware, policy and storage for metric spiders.
+
+Enable in place of Scrapy's HttpCacheMiddleware:
+
+    DOWNLOADER_MIDDLEWARES = {
+        'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+        'httpcache.RevalidatingCacheMiddleware': 900,
+    }
+    HTTPCACHE_ENABLED = True
+    HTTPCACHE_POLICY = 'httpcache.FreshnessPolicy'
+    HTTPCACHE_STORAGE = 'httpcache.SqliteCacheStorage'
+"""
+
+from email.utils import formatdate
+import os
+import sqlite3
+import time
+import zlib
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+
+class FreshnessPolicy(RFC2616Policy):
+    """
+    RFC2616 policy with a fixed freshness window.
+
+    Cached pages younger than HTTPCACHE_FRESHNESS_SECS are used without
+    touching the network. Older pages are revalidated with If-None-Match and
+    If-Modified-Since, so an unchanged page costs a 304 rather than a full
+    download. Spiders set their own window in custom_settings; without one,
+    freshness comes from the response headers as usual.
+
+    Only 200 responses are stored, otherwise a throttled or failed page would
+    be served from the cache, retries included, for a whole window.
+    """
+
+    def __init__(self, settings):
+        super(FreshnessPolicy, self).__init__(settings)
+        self.freshness = settings.getint('HTTPCACHE_FRESHNESS_SECS')
+
+    def should_cache_response(self, response, request):
+        if response.status != 200:
+            return False
+        return super(FreshnessPolicy, self).should_cache_response(response, request)
+
+    def _compute_freshness_lifetime(self, response, request, now):
+        if self.freshness:
+            return self.freshness
+        return super(FreshnessPolicy, self)._compute_freshness_lifetime(
+            response, request, now
+        )
+
+
+class RevalidatingCacheMiddleware(HttpCacheMiddleware):
+    """
+    HttpCacheMiddleware which stores a cached page again when a 304 confirms
+    it is still valid.
+
+    Scrapy hands back the cached page without storing it, so its Date never
+    moves on and once it is older than the freshness window every later crawl
+    revalidates it again. Here the page is stored with the Date and validators
+    of the 304, which starts a new freshness window.
+    """
+
+    refreshed_headers = ('Date', 'Expires', 'Cache-Control', 'ETag', 'Last-Modified')
+
+    def process_response(self, request, response, spider):
+        cachedresponse = request.meta.get('cached_response')
+        result = super(RevalidatingCacheMiddleware, self).process_response(
+            request, response, spider
+        )
+        if cachedresponse is None or result is not cachedresponse:
+            return result
+        headers = cachedresponse.headers.copy()
+        for name in self.refreshed_headers:
+            if name in response.headers:
+                headers[name] = response.headers.getlist(name)
+        refreshed = cachedresponse.replace(headers=headers)
+        self.storage.store_response(spider, request, refreshed)
+        return refreshed
+
+
+class SqliteCacheStorage(object):
+    """
+    Stores cached responses in a SQLite database per spider.
+
+    Scrapy's filesystem storage makes a directory and several files for every
+    page, which is slow and wasteful for many small pages. Here each page is a
+    single row with a zlib compressed body, and writes are committed in
+    batches.
+    """
+
+    commit_interval = 100
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.connection = None
+        self.pending = 0
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, '%s.sqlite' % spider.name)
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' fingerprint TEXT PRIMARY KEY,'
+            ' url TEXT NOT NULL,'
+            ' status INTEGER NOT NULL,'
+            ' headers BLOB NOT NULL,'
+            ' body BLOB NOT NULL,'
+            ' tsecs REAL NOT NULL'
+            ')'
+        )
+        self.connection.commit()
+
+    def close_spider(self, _):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def retrieve_response(self, _, request):
+        """Get the cached response to a request, or None."""
+        row = self.connection.execute(
+            'SELECT url, status, headers, body, tsecs FROM responses WHERE fingerprint = ?',
+            (request_fingerprint(request),)
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, raw_headers, body, tsecs = row
+        if self.expiration_secs and time.time() - tsecs > self.expiration_secs:
+            return None
+        headers = Headers(headers_raw_to_dict(str(raw_headers)))
+        # freshness is measured from the Date header, so make sure there is one
+        if 'Date' not in headers:
+            headers['Date'] = formatdate(tsecs, usegmt=True)
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        return respcls(
+            url=url, headers=headers, status=status, body=zlib.decompress(body)
+        )
+
+    def store_response(self, _, request, response):
+        """Store a response, replacing any previous response to the request."""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                request_fingerprint(request),
+                response.url,
+                response.status,
+                sqlite3.Binary(headers_dict_to_raw(response.headers)),
+                sqlite3.Binary(zlib.compress(response.body)),
+                time.time(),
+            )
+        )
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.connection.commit()
+            self.pending = 0
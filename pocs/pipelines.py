@@ -3,22 +3,204 @@
 Scrapy Pipelines for dealing with scraped metrics.
 """
 
+from collections import OrderedDict
+import gzip
 import json
+import os
+import time
+
+from scrapy.exceptions import DropItem
+
+
+class DedupPipeline(object):
+    """
+    Drops repeated metrics, keeping the first item for each metric name,
+    domain and time bucket.
+
+    Duplicates come from retried requests, or from start urls for the same
+    domain. Only the most recently seen keys are remembered, so memory is
+    bounded on long crawls. Configured with these settings:
+
+        METRICS_DEDUP_BUCKET_SECS: Width of the time buckets.
+        METRICS_DEDUP_MAX_KEYS: Number of keys to remember.
+
+    Items without a domain are passed through untouched.
+    """
+
+    def __init__(self, bucket_secs=60 * 60, max_keys=100000, stats=None):
+        self.bucket_secs = bucket_secs
+        self.max_keys = max_keys
+        self.stats = stats
+        self.seen = OrderedDict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            bucket_secs=settings.getint('METRICS_DEDUP_BUCKET_SECS', 60 * 60),
+            max_keys=settings.getint('METRICS_DEDUP_MAX_KEYS', 100000),
+            stats=crawler.stats,
+        )
+
+    def get_key(self, item):
+        """The identity of a metric item, None if it can't be deduplicated."""
+        domain = item.get('domain')
+        if not domain:
+            return None
+        bucket = int((item.get('tsecs') or 0) // self.bucket_secs)
+        return (item.get('name'), domain.lower(), bucket)
+
+    def process_item(self, item, spider):
+        key = self.get_key(item)
+        if key is None:
+            return item
+        if key in self.seen:
+            # keep the key fresh, it is clearly still in play
+            del self.seen[key]
+            self.seen[key] = None
+            if self.stats:
+                self.stats.inc_value('metrics_dedup/dropped', spider=spider)
+            raise DropItem('duplicate metric %s for %s' % (key[0], key[1]))
+        self.seen[key] = None
+        if len(self.seen) > self.max_keys:
+            self.seen.popitem(last=False)
+        return item
+
 
 class JsonWriterPipeline(object):
-    """Basic pipeline which dumps items to a .jl file."""
+    """
+    Appends items to a .jl file, one JSON object per line.
 
-    def __init__(self, *args, **kwargs):
-        super(JsonWriterPipeline, self).__init__(*args, **kwargs)
+    Lines are buffered and written in large blocks, optionally compressed, and
+    the file is rotated once it gets too big or too old. Configured with these
+    settings:
+
+        METRICS_OUTPUT_PATH: File to append to, may include %(name)s for the
+            spider's name.
+        METRICS_OUTPUT_COMPRESS: None, 'gzip' or 'zstd' (needs zstandard).
+        METRICS_OUTPUT_BUFFER_BYTES: Bytes of lines to buffer before writing.
+        METRICS_OUTPUT_ROTATE_BYTES: Rotate once the file holds this many
+            bytes, including those appended by earlier crawls. Compressed
+            files count the uncompressed bytes of this crawl only.
+        METRICS_OUTPUT_ROTATE_SECS: Rotate after the file has been open this
+            long.
+
+    Rotated files are renamed with the time of rotation before their
+    extension, e.g. items-20160601T120000.jl.gz
+    """
+
+    compressed_extensions = ('.gz', '.zst')
+
+    def __init__(self, path='items.jl', compress=None, buffer_bytes=1024 * 1024,
+                 rotate_bytes=0, rotate_secs=0):
+        self.path = path
+        if compress not in (None, 'gzip', 'zstd'):
+            raise UserWarning('unknown output compression %s' % compress)
+        self.compress = compress
+        self.buffer_bytes = buffer_bytes
+        self.rotate_bytes = rotate_bytes
+        self.rotate_secs = rotate_secs
+        self.file = None
+        self.stream = None
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.opened = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            path=settings.get('METRICS_OUTPUT_PATH', 'items.jl'),
+            compress=settings.get('METRICS_OUTPUT_COMPRESS') or None,
+            buffer_bytes=settings.getint('METRICS_OUTPUT_BUFFER_BYTES', 1024 * 1024),
+            rotate_bytes=settings.getint('METRICS_OUTPUT_ROTATE_BYTES', 0),
+            rotate_secs=settings.getint('METRICS_OUTPUT_ROTATE_SECS', 0),
+        )
+
+    def open_stream(self):
+        """Open the output file for appending."""
+        out_dir = os.path.dirname(self.path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.file = open(self.path, 'ab')
+        if self.compress == 'gzip':
+            # appending starts a new gzip member, readers see one stream
+            self.stream = gzip.GzipFile(fileobj=self.file, mode='ab')
+        elif self.compress == 'zstd':
+            try:
+                #pylint: disable=import-error
+                import zstandard
+            except ImportError:
+                raise UserWarning('zstandard is required for zstd output')
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file)
+        else:
+            self.stream = self.file
+        # an uncompressed file's size is the bytes of lines already in it
+        self.written = 0 if self.compress else os.path.getsize(self.path)
+        self.opened = time.time()
+
+    def close_stream(self):
+        """Write out the buffer and close the output file."""
+        self.flush()
+        if self.stream is not self.file:
+            self.stream.close()
+        if not self.file.closed:
+            self.file.close()
+        self.stream = None
         self.file = None
 
-    def open_spider(self, _):
-        self.file = open('items.jl', 'wb')
+    def flush(self):
+        """Write the buffered lines in one block."""
+        if not self.buffer:
+            return
+        self.stream.write(''.join(self.buffer))
+        self.written += self.buffered
+        self.buffer = []
+        self.buffered = 0
+
+    def rotated_path(self):
+        """Get an unused name for the current file once rotated."""
+        root, ext = os.path.splitext(self.path)
+        if ext in self.compressed_extensions:
+            root, inner_ext = os.path.splitext(root)
+            ext = inner_ext + ext
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        path = '%s-%s%s' % (root, stamp, ext)
+        count = 1
+        while os.path.exists(path):
+            path = '%s-%s.%d%s' % (root, stamp, count, ext)
+            count += 1
+        return path
+
+    def rotate(self):
+        """Move the current file aside and start a new one."""
+        self.close_stream()
+        os.rename(self.path, self.rotated_path())
+        self.open_stream()
+
+    def should_rotate(self):
+        """Whether the current file is too big or too old."""
+        if self.rotate_bytes and self.written + self.buffered >= self.rotate_bytes:
+            return True
+        if self.rotate_secs and time.time() - self.opened >= self.rotate_secs:
+            return True
+        return False
+
+    def open_spider(self, spider):
+        if '%(name)s' in self.path:
+            self.path = self.path % {'name': spider.name}
+        self.open_stream()
 
     def close_spider(self, _):
-        self.file.close()
+        self.close_stream()
 
     def process_item(self, item, _):
         line = json.dumps(dict(item)) + "\n"
-        self.file.write(line)
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.should_rotate():
+            self.rotate()
+        elif self.buffered >= self.buffer_bytes:
+            self.flush()
         return item
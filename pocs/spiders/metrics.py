@@ -3,15 +3,124 @@
 Collection of spiders for scraping popularity metrics.
 """
 
+import re
 import sys
 import os
 
+from cssselect import GenericTranslator
+from lxml import etree
+import lxml.html
 import scrapy
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../..')))
 import scrapop
-from scrapop.utils import TimeHelpers
+from scrapop.utils import SanitationUtils, TimeHelpers, UrlUtils
+
+class MetricExtractor(object):
+    """
+    Pulls a single metric value out of a page with a precompiled selector.
+
+    If the page has a prefilter marker, e.g. the id of the section holding
+    the metric, only the `window` bytes around the marker are parsed. The
+    whole page is parsed when there is no marker, or the fragment doesn't
+    hold all of the metric.
+    """
+
+    def __init__(self, xpath=None, css=None, prefilter=None, window=8192):
+        if css and not xpath:
+            xpath = GenericTranslator().css_to_xpath(css)
+        if not xpath:
+            raise UserWarning('a metric xpath or css selector is required')
+        self.xpath = etree.XPath(xpath)
+        self.prefilter = prefilter
+        self.window = window
+        self.parsers = {}
+
+    def get_parser(self, encoding):
+        """Get an html parser for an encoding, shared between pages."""
+        if encoding not in self.parsers:
+            self.parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+        return self.parsers[encoding]
+
+    @classmethod
+    def to_value(cls, result):
+        """Convert an xpath result to the stripped text of the metric."""
+        if isinstance(result, basestring):
+            text = result
+        else:
+            text = result.text_content()
+        return u' '.join(text.split()) or None
+
+    def match(self, body, encoding):
+        """
+        Parse body and get the first result matching the selector, with its
+        value, or (None, None).
+        """
+        try:
+            root = lxml.html.document_fromstring(body, parser=self.get_parser(encoding))
+        except (etree.ParserError, ValueError):
+            return None, None
+        for result in self.xpath(root):
+            value = self.to_value(result)
+            if value is not None:
+                return result, value
+        return None, None
+
+    def extract_from(self, body, encoding):
+        """Parse body and get the first value matching the selector."""
+        return self.match(body, encoding)[1]
+
+    def extract_fast(self, body, encoding):
+        """
+        Get the value by parsing only the fragment around the prefilter.
+
+        The parser quietly closes any elements left open where the fragment
+        was cut, which may be part way through the metric. So unless the
+        fragment runs to the end of the page, the value only counts if the
+        closing tag of its element follows the end of its text.
+        """
+        index = body.find(self.prefilter)
+        if index < 0:
+            return None
+        start = body.rfind('<', 0, index)
+        if start < 0:
+            return None
+        fragment = body[start:start + self.window]
+        result, value = self.match(fragment, encoding)
+        if value is None or start + self.window >= len(body):
+            return value
+        element = result
+        if isinstance(result, basestring):
+            element = result.getparent() if hasattr(result, 'getparent') else None
+        if element is None or not isinstance(element.tag, basestring):
+            return None
+        try:
+            last_text = value.split()[-1].encode(encoding or 'utf-8')
+        except (LookupError, UnicodeError):
+            return None
+        text_end = fragment.rfind(last_text)
+        if text_end < 0 or fragment.find('</%s' % element.tag, text_end) < 0:
+            return None
+        return value
+
+    def extract(self, body, encoding='utf-8'):
+        """
+        Get the metric value from a page.
+
+        Args:
+            body (str): The raw page.
+            encoding (basestring): The page's encoding.
+
+        Returns:
+            unicode: The value, or None if the page doesn't have one.
+        """
+        if self.prefilter:
+            value = self.extract_fast(body, encoding)
+            if value is not None:
+                return value
+        return self.extract_from(body, encoding)
+
 
 class PopMetric(scrapy.Item):
     """A value of a given metric at a particular time."""
@@ -19,11 +128,25 @@ class PopMetric(scrapy.Item):
     value = scrapy.Field()
     name = scrapy.Field()
     tsecs = scrapy.Field()
+    domain = scrapy.Field()
 
 class PopSpider(scrapy.Spider):
-    """Abstract popularity metric spider."""
+    """
+    Abstract popularity metric spider.
+
+    Crawls either a single `start_url`, or the page given by `url_template`
+    for each of `domains`, a list or a comma separated string.
+    """
 
     name = "popularity"
+    # page holding the metric for a domain, e.g. "http://example.com/%s"
+    url_template = None
+    # the metric is found with one of these selectors
+    metric_xpath = None
+    metric_css = None
+    # bytes which appear just before the metric, to avoid parsing whole pages
+    metric_prefilter = None
+    metric_prefilter_window = 8192
 
     def __init__(self, *args, **kwargs):
         super(PopSpider, self).__init__(*args, **kwargs)
@@ -33,22 +156,66 @@ class PopSpider(scrapy.Spider):
             if start_url:
                 self.start_urls.append(start_url)
 
+        domains = getattr(self, 'domains', None) or []
+        if isinstance(domains, basestring):
+            domains = [domain.strip() for domain in domains.split(',') if domain.strip()]
+        self.domains = domains
+        if self.domains and not self.url_template:
+            raise UserWarning('%s spider can not crawl domains' % self.name)
+
+    def domain_of(self, url):
+        """Get the domain whose metric page is url, or None."""
+        if not self.url_template:
+            return None
+        prefix, _, suffix = self.url_template.partition('%s')
+        if url.startswith(prefix) and url.endswith(suffix):
+            return url[len(prefix):len(url) - len(suffix)] or None
+        return None
+
+    def start_requests(self):
+        for request in super(PopSpider, self).start_requests():
+            # so start_url items have a domain too, and can be deduplicated
+            if request.meta.get('domain') is None:
+                domain = self.domain_of(request.url)
+                if domain:
+                    request.meta['domain'] = UrlUtils.only_domain(domain)
+            yield request
+        # lazily, so the scheduler isn't loaded with every domain up front
+        for domain in self.domains:
+            yield scrapy.Request(
+                self.url_template % domain,
+                callback=self.parse,
+                meta={'domain': domain}
+            )
+
+    @classmethod
+    def get_extractor(cls):
+        """
+        Get the metric extractor for this spider class, compiling its selector
+        on first use.
+        """
+        # look in the class's own dict, subclasses have their own selectors
+        if '_extractor' not in cls.__dict__:
+            if not (cls.metric_xpath or cls.metric_css):
+                cls._extractor = None
+            else:
+                cls._extractor = MetricExtractor(
+                    xpath=cls.metric_xpath,
+                    css=cls.metric_css,
+                    prefilter=cls.metric_prefilter,
+                    window=cls.metric_prefilter_window
+                )
+        return cls._extractor
+
     def parse(self, response):
         self.log('parsing: {response}'.format(response=response))
 
-        metric_value = None
-        if hasattr(self, 'metric_xpath'):
-            selector = getattr(self, 'metric_xpath')
-            if selector:
-                metric_value = response.xpath(selector).extract_first()
-        elif hasattr(self, 'metric_css'):
-            selector = getattr(self, 'metric_css')
-            if selector:
-                metric_value = response.css(selector).extract_first()
-        else:
+        extractor = self.get_extractor()
+        if extractor is None:
             self.log('No selector found')
             return
 
+        metric_value = extractor.extract(response.body, response.encoding)
         if metric_value is None:
             self.log('no metric_value found')
             return
@@ -57,6 +224,7 @@ class PopSpider(scrapy.Spider):
             name=self.name,
             value=metric_value,
             tsecs=TimeHelpers.current_tsecs(),
+            domain=response.meta.get('domain'),
         )
 
 
@@ -65,7 +233,20 @@ class AlexaSpider(PopSpider):
     """Spider for Alexa-like popularity metrics."""
 
     name = "alexa"
+    url_template = "http://www.alexa.com/siteinfo/%s"
+    # ranks are updated daily
+    custom_settings = {
+        'HTTPCACHE_FRESHNESS_SECS': 24 * 60 * 60,
+    }
     metric_css = "section#traffic-rank-content strong.metrics-data"
+    metric_prefilter = 'id="traffic-rank-content"'
+    siteinfo_pattern = re.compile(SanitationUtils.re_alexa_siteinfo_url)
 
     def __init__(self, *args, **kwargs):
         super(AlexaSpider, self).__init__(*args, **kwargs)
+
+    def domain_of(self, url):
+        match = self.siteinfo_pattern.match(url)
+        if match:
+            return match.group('domain')
+        return super(AlexaSpider, self).domain_of(url)
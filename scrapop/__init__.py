@@ -2,4 +2,8 @@
 Module for scraping site popularity metrics, storing in Google Drive.
 """
 
-from scrapop.core import main
+
+def main():
+    """Run scrapop.core.main, which is only imported when called."""
+    from scrapop.core import main as core_main
+    return core_main()
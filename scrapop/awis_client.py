@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Keep-alive client for the AWIS API.
+"""
+
+from io import BytesIO
+import threading
+
+import httplib2
+from awis import AwisApi
+#pylint: disable=no-name-in-module
+from lxml.etree import parse as etree_parse
+
+from scrapop.utils import AwisError, AwisAuthError
+
+
+class AwisClient(AwisApi):
+    """
+    AWIS API client which keeps its connections alive between requests.
+
+    httplib2.Http objects are not thread safe, so each thread gets its own
+    pooled connection.
+    """
+
+    # error codes AWIS gives with a 400 when the request isn't authentic
+    auth_error_codes = (
+        'AuthFailure', 'IncompleteSignature', 'InvalidAccessKeyId',
+        'InvalidClientTokenId', 'MissingAuthenticationToken', 'SignatureDoesNotMatch',
+    )
+
+    def __init__(self, access_id, secret_access_key, host=None, timeout=30):
+        super(AwisClient, self).__init__(access_id, secret_access_key)
+        if host:
+            self.AWIS_HOST = host
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def http(self):
+        """The connection pool for the current thread."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = httplib2.Http(timeout=self.timeout)
+            self._local.http = http
+        return http
+
+    def request(self, params, tries=1, as_xml=True):
+        """
+        Sign and make a request, failed requests are left to the caller to retry.
+        """
+        params.update({
+            "AWSAccessKeyId": self.access_id,
+            "SignatureMethod": "HmacSHA1",
+            "SignatureVersion": 2,
+            "Timestamp": self._get_timestamp(),
+        })
+        params["Signature"] = self.sign(params)
+        url = "http://%s%s?%s" % (self.AWIS_HOST, self.PATH, self._urlencode(params))
+        for attempt in range(tries):
+            response, content = self.http.request(url, 'GET')
+            if response.status == 200:
+                if as_xml:
+                    return etree_parse(BytesIO(content))
+                return content
+        if response.status >= 500 or response.status == 429:
+            raise IOError("AWIS request failed, response code is %d" % response.status)
+        if response.status in (401, 403) or (
+                response.status == 400
+                and any(code in content for code in self.auth_error_codes)
+        ):
+            raise AwisAuthError("AWIS request not authorized, response code is %d: %s" % (
+                response.status, content
+            ))
+        raise AwisError("AWIS request rejected, response code is %d: %s" % (
+            response.status, content
+        ))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of popularity metrics.
+"""
+
+from __future__ import print_function
+import os
+import sqlite3
+
+from scrapop.utils import TimeHelpers
+
+
+class MetricsCache(object):
+    """
+    SQLite backed cache of metric values keyed by domain and metric name.
+
+    Each metric has its own time to live, a domain is only a cache hit if every
+    requested metric is present and younger than its ttl.
+    """
+
+    default_ttl = 24 * 60 * 60
+    default_ttls = {
+        'Rank': 24 * 60 * 60,
+        'LinksInCount': 7 * 24 * 60 * 60,
+        'Speed': 7 * 24 * 60 * 60,
+    }
+    # Keep below SQLITE_MAX_VARIABLE_NUMBER
+    query_batch_size = 500
+
+    def __init__(self, path, ttls=None, refresh=False):
+        """
+        Args:
+            path (basestring): Location of the cache database.
+            ttls (dict): Mapping of metric name to ttl in seconds, overrides
+                default_ttls.
+            refresh (bool): Ignore cached values, only store new ones.
+        """
+        self.path = os.path.expanduser(path)
+        self.ttls = dict(self.default_ttls)
+        self.ttls.update(ttls or {})
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            ' domain TEXT NOT NULL,'
+            ' metric TEXT NOT NULL,'
+            ' value,'
+            ' tsecs REAL NOT NULL,'
+            ' PRIMARY KEY (domain, metric)'
+            ')'
+        )
+        self.connection.commit()
+
+    @classmethod
+    def parse_ttls(cls, specs):
+        """
+        Parse a list of METRIC=SECONDS strings into a dict of ttls.
+        """
+        ttls = {}
+        for spec in specs or []:
+            metric, _, seconds = spec.partition('=')
+            try:
+                ttls[metric.strip()] = float(seconds)
+            except ValueError:
+                raise UserWarning('invalid cache ttl %s, expected METRIC=SECONDS' % repr(spec))
+        return ttls
+
+    def get_ttl(self, metric):
+        """Get the time to live of a metric in seconds."""
+        return self.ttls.get(metric, self.default_ttl)
+
+    def get_many(self, domains, metric_names):
+        """
+        Get cached metrics for each domain that has fresh values for all metrics.
+
+        Returns:
+            dict: mapping of domain to a dict of metric values.
+        """
+        if self.refresh:
+            self.misses += len(domains)
+            return {}
+
+        now = TimeHelpers.current_tsecs()
+        found = {}
+        for index in range(0, len(domains), self.query_batch_size):
+            batch = domains[index:index + self.query_batch_size]
+            rows = self.connection.execute(
+                'SELECT domain, metric, value, tsecs FROM metrics WHERE domain IN (%s)' \
+                    % ','.join('?' * len(batch)),
+                batch
+            )
+            for domain, metric, value, tsecs in rows:
+                if metric in metric_names and now - tsecs < self.get_ttl(metric):
+                    found.setdefault(domain, {})[metric] = value
+
+        hits = {}
+        for domain in domains:
+            domain_metrics = found.get(domain, {})
+            if all(metric in domain_metrics for metric in metric_names):
+                hits[domain] = dict(
+                    (metric, domain_metrics[metric]) for metric in metric_names
+                )
+        self.hits += len(hits)
+        self.misses += len(domains) - len(hits)
+        return hits
+
+    def set_many(self, metrics):
+        """
+        Store freshly fetched metrics.
+
+        Args:
+            metrics (dict): mapping of domain to a dict of metric values.
+        """
+        now = TimeHelpers.current_tsecs()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO metrics (domain, metric, value, tsecs) VALUES (?, ?, ?, ?)',
+            [
+                (domain, metric, value, now) \
+                for domain, domain_metrics in metrics.items() \
+                for metric, value in domain_metrics.items()
+            ]
+        )
+        self.connection.commit()
+
+    def close(self):
+        """Close the underlying database."""
+        self.connection.close()
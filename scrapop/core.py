@@ -3,42 +3,174 @@ Core methods for scraping data from Popularity metrics websites and storing in g
 """
 
 from __future__ import print_function
-from collections import OrderedDict
-import re
+from collections import OrderedDict, namedtuple
+from itertools import islice, izip
+import os
 
 import configargparse
-from oauth2client import tools
 
 from scrapop.utils import (GssUtils, AwisUtils, UrlUtils, ListUtils,
                            SanitationUtils)
+from scrapop.fetch import MetricsFetcher
+from scrapop.cache import MetricsCache
+from scrapop.journal import RunJournal
+from scrapop.history import MetricsHistory
+from scrapop.throttle import TokenBucket, AdaptiveBatcher
+from scrapop.report import ReportUtils
+from scrapop.stats import Stats
+from scrapop.shard import ShardUtils
+from scrapop.records import CellTable
 from pprint import pformat
-from tabulate import tabulate
 
-def extract_targets(cells):
+def extract_targets(cells, first_row=1, batch_size=5000):
     """
-    Extracts unique domains from list of gss cells.
+    Extracts unique domains from an iterable of gss cells.
+
+    Each cell's info records the sheet row it came from, counting from
+    first_row. Cells are consumed batch_size at a time.
+
+    Returns:
+        tuple: the unique domains in the order they were first seen, and a
+            CellTable of the cells.
     """
-    cell_info = []
-    unique_domains = set()
-    for cell in ListUtils.get_firsts(cells):
-        if not cell:
-            # cell_info.append(CellInfo(cell, None, errors='empty cell'))
-            cell_info.append({'cell':cell, 'errors':'empty cell'})
-        try:
-            domain = SanitationUtils.extract_target_gss_cell(cell)
-        except Exception, exc:
-            # cell_info.append(CellInfo(cell, None, errors=str(exc)))
-            cell_info.append({'cell':cell, 'errors':str(exc)})
-            continue
-        if not domain:
-            # cell_info.append(CellInfo(cell, None, errors='could not extract domain'))
-            cell_info.append({'cell':cell, 'errors':'could not extract domain'})
-            continue
-        # cell_info.append(CellInfo(cell, domain.lower(), None))
-        cell_info.append({'cell':cell, 'domain':domain.lower()})
-        unique_domains.add(domain.lower())
-
-    return list(unique_domains), cell_info
+    cell_info = CellTable()
+    firsts = ListUtils.iter_firsts(cells)
+    row = first_row
+    while True:
+        batch = list(islice(firsts, batch_size))
+        if not batch:
+            break
+        # the cell table's domain index already dedupes the domains
+        domains, errors, _ = SanitationUtils.extract_target_gss_cells(
+            batch, track_unique=False
+        )
+        for cell, domain, error in zip(batch, domains, errors):
+            cell_info.append(row, cell, domain, error)
+            row += 1
+
+    return cell_info.domains.names, cell_info
+
+# A column of target cells, and where its report goes.
+Target = namedtuple('Target', ['file_id', 'sheet', 'column', 'out_file'])
+
+def parse_targets(options):
+    """
+    Get the targets of a run, from each --target or else from --file-id.
+
+    A target spec is FILE_ID[:SHEET[:COLUMN[:OUT_FILE]]], missing parts take
+    the values of --target-sheet and --target-column. Sheet names can't hold a
+    colon, out files can. Without an out file, the report is --out-file,
+    numbered by the target's position if there are several targets.
+    """
+    if not options.target:
+        if not options.file_id:
+            return []
+        return [Target(
+            options.file_id, options.target_sheet, options.target_column, options.out_file
+        )]
+
+    root, ext = os.path.splitext(options.out_file)
+    if ext == '.gz':
+        root, inner_ext = os.path.splitext(root)
+        ext = inner_ext + ext
+    targets = []
+    for index, spec in enumerate(options.target):
+        parts = spec.split(':', 3)
+        if not parts[0]:
+            raise UserWarning(
+                'invalid target %s, expected FILE_ID[:SHEET[:COLUMN[:OUT_FILE]]]' % repr(spec)
+            )
+        parts += [None] * (4 - len(parts))
+        out_file = parts[3]
+        if not out_file:
+            out_file = options.out_file
+            if len(options.target) > 1:
+                out_file = '%s.%d%s' % (root, index, ext)
+        targets.append(Target(
+            parts[0],
+            parts[1] or options.target_sheet,
+            parts[2] or options.target_column,
+            out_file
+        ))
+    return targets
+
+def write_results(options, target, cell_info, metrics, errors, metric_names):
+    """
+    Match fetched metrics back to the target cells, then write them back to
+    the sheet and to the report.
+
+    Args:
+        target (Target): Where the cells came from.
+        cell_info (CellTable): The cells from extract_targets.
+        metrics (MetricTable): The metrics of each normalized domain.
+        errors (dict): mapping of normalized domain to the reason it could not
+            be fetched.
+        metric_names (list): The metrics fetched in this run.
+    """
+
+    # look up each distinct domain once, rather than once per cell
+    normalized = UrlUtils.only_domains(cell_info.domains.names)
+    metric_ids = metrics.get_ids(normalized)
+    domain_errors = [errors.get(domain) for domain in normalized]
+    missing = [None] * len(metric_names)
+
+    def iter_cell_results():
+        """Yield the domain, metric values and error of each cell."""
+        for index, domain_id in enumerate(cell_info.domain_ids):
+            if domain_id < 0:
+                yield None, missing, cell_info.get_error(index)
+            elif metric_ids[domain_id] < 0:
+                yield cell_info.domains[domain_id], missing, domain_errors[domain_id]
+            else:
+                yield (
+                    cell_info.domains[domain_id],
+                    metrics.get_values(metric_ids[domain_id]),
+                    None
+                )
+
+    report_headers = OrderedDict([
+        ('domain', 'Domain'),
+    ] \
+    + [(metric_name, metric_name) for metric_name in metric_names] \
+    + [
+        ('errors', 'Errors'),
+        ('cell', 'Cell')
+    ])
+    # report_headers = ['domain'] + metric_names + ['errors', 'cell']
+
+    if options.write_back:
+        write_column = GssUtils.column_letters(
+            GssUtils.column_index(target.column) + 1
+        )
+        rows = {}
+        for row, (_, values, _) in izip(cell_info.rows, iter_cell_results()):
+            if any(value is not None for value in values):
+                rows[row] = values
+        with Stats.stage('write_back'):
+            written = GssUtils.update_rows(
+                target.file_id,
+                target.sheet,
+                write_column,
+                rows,
+                options=options
+            )
+        Stats.incr('cells_written', written)
+        print("wrote %d changed cells to %s" % (written, target.sheet))
+
+    with Stats.stage('report'):
+        row_count = ReportUtils.write_report(
+            target.out_file,
+            report_headers,
+            (
+                [domain] + values + [error, cell] \
+                for (domain, values, error), cell \
+                in izip(iter_cell_results(), cell_info.cells)
+            ),
+            fmt=options.out_format,
+            compress=options.out_compress
+        )
+    print("wrote %d rows to report %s" % (row_count, target.out_file))
+
 
 def main():
     """Main function for scraping Alexa popularity metric data."""
@@ -46,7 +178,7 @@ def main():
     # Parse arguments
     argparser = configargparse.ArgumentParser(
         description="Scrape and store popularity metrics",
-        parents=[tools.argparser]
+        parents=[GssUtils.get_flags_parser()]
     )
 
     argparser.add_argument(
@@ -54,6 +186,11 @@ def main():
         is_config_file=True,
         help='config file path'
     )
+    argparser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='Print the options in effect and where they came from'
+    )
 
     gdrive_group = argparser.add_argument_group('Google Drive Options')
     gdrive_group.add_argument(
@@ -65,7 +202,6 @@ def main():
     gdrive_group.add_argument(
         '--file-id',
         help='The ID of the file to store the popularity metrics',
-        required=True,
         metavar='ID'
     )
     gdrive_group.add_argument(
@@ -80,12 +216,81 @@ def main():
         default='A',
         metavar='COL'
     )
+    gdrive_group.add_argument(
+        '--target',
+        action='append',
+        help='A column to get metrics for, instead of --file-id. Repeat, or give '
+        'a list in the config file, to fetch the domains of many sheets at once. '
+        'SHEET can\'t contain a colon',
+        metavar='FILE_ID[:SHEET[:COL[:OUT_FILE]]]'
+    )
+    gdrive_group.add_argument(
+        '--read-window',
+        type=int,
+        help='Number of rows of the target column to read per range',
+        default=5000,
+        metavar='ROWS'
+    )
+    gdrive_group.add_argument(
+        '--read-concurrency',
+        type=int,
+        help='Number of requests for the target column to make at once',
+        default=1,
+        metavar='N'
+    )
+    gdrive_group.add_argument(
+        '--write-back',
+        action='store_true',
+        help='Write metrics into the columns following the target column'
+    )
 
     awis_group = argparser.add_argument_group('Alexis Options')
     awis_group.add_argument(
         '--requests-limit',
         type=int,
-        help='Limit the number of popularity metric api requests'
+        help='Limit the number of popularity metric api requests, split between shards'
+    )
+    awis_group.add_argument(
+        '--concurrency',
+        type=int,
+        help='Number of chunks of domains to request from AWIS at once',
+        default=4,
+        metavar='N'
+    )
+    awis_group.add_argument(
+        '--rate-limit',
+        type=float,
+        help='Maximum sustained number of AWIS requests per second',
+        metavar='RPS'
+    )
+    awis_group.add_argument(
+        '--burst',
+        type=int,
+        help='Number of AWIS requests allowed back to back under the rate limit',
+        default=1,
+        metavar='N'
+    )
+    awis_group.add_argument(
+        '--chunk-size',
+        type=int,
+        help='Largest number of domains per AWIS request (at most %d)' \
+            % AwisUtils.max_batch_size,
+        default=AwisUtils.max_batch_size,
+        metavar='N'
+    )
+    awis_group.add_argument(
+        '--target-latency',
+        type=float,
+        help='Shrink the chunk size when AWIS requests take longer than this',
+        default=5.0,
+        metavar='SECS'
+    )
+    awis_group.add_argument(
+        '--max-retries',
+        type=int,
+        help='Number of times to retry an AWIS request after a transient failure',
+        default=3,
+        metavar='N'
     )
     awis_group.add_argument(
         '--key-id',
@@ -100,11 +305,102 @@ def main():
         required=True
     )
 
+    argparser.add_argument(
+        '--suffix-list-file',
+        help='Public suffix list to use instead of the snapshot bundled with tldextract',
+        metavar='FILE'
+    )
+
+    cache_group = argparser.add_argument_group('Cache Options')
+    cache_group.add_argument(
+        '--cache-file',
+        help='Location of the metrics cache database',
+        default='~/.scrapop/metrics_cache.sqlite',
+        metavar='FILE'
+    )
+    cache_group.add_argument(
+        '--cache-ttl',
+        action='append',
+        help='Time in seconds a cached metric stays fresh, e.g. Rank=86400',
+        metavar='METRIC=SECONDS'
+    )
+    cache_group.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Bypass the metrics cache entirely'
+    )
+    cache_group.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        help='Ignore cached metrics but store freshly fetched ones'
+    )
+
+    cache_group.add_argument(
+        '--history-dir',
+        help='Also append freshly fetched metrics to the history in this directory',
+        metavar='DIR'
+    )
+
+    journal_group = argparser.add_argument_group('Journal Options')
+    journal_group.add_argument(
+        '--journal-file',
+        help='Location of the journal of chunks completed in this run',
+        default='scrapop_journal.jl',
+        metavar='FILE'
+    )
+    journal_group.add_argument(
+        '--resume',
+        action='store_true',
+        help='Only fetch domains not already recorded in the journal'
+    )
+
     argparser.add_argument(
         '-o', '--out-file',
         help='Location to store report',
         default='report.html'
     )
+    argparser.add_argument(
+        '--out-format',
+        choices=ReportUtils.formats,
+        help='Format of the report, guessed from the out file extension by default'
+    )
+    argparser.add_argument(
+        '--out-compress',
+        choices=['gzip'],
+        help='Compress the report, implied by a .gz out file extension'
+    )
+
+    stats_group = argparser.add_argument_group('Stats Options')
+    stats_group.add_argument(
+        '--stats-json',
+        help='Write stage timings, counters and latency histograms to this JSON file',
+        metavar='FILE'
+    )
+    stats_group.add_argument(
+        '--stats-prom',
+        help='Write the same stats to this Prometheus textfile, e.g. for node_exporter',
+        metavar='FILE'
+    )
+
+    shard_group = argparser.add_argument_group('Shard Options')
+    shard_group.add_argument(
+        '--shard',
+        help='Only fetch the domains in shard INDEX of COUNT, counting from 0. '
+        'Results go to a journal per shard, to be combined with --merge-shards',
+        metavar='INDEX/COUNT'
+    )
+    shard_group.add_argument(
+        '--shards',
+        type=int,
+        help='Fetch in this many local worker processes, one per shard, then merge',
+        metavar='COUNT'
+    )
+    shard_group.add_argument(
+        '--merge-shards',
+        type=int,
+        help='Report and write back the results of this many shard journals',
+        metavar='COUNT'
+    )
 
     options = argparser.parse_args()
 
@@ -112,106 +408,163 @@ def main():
     #
     # ).parse_args(options.gsheet_flags)
 
-    print(options)
-    print("----------")
-    print(argparser.format_help())
-    print("----------")
-    print(argparser.format_values())
+    if options.verbose:
+        print(options)
+        print("----------")
+        print(argparser.format_values())
 
-    options.scopes = 'https://www.googleapis.com/auth/spreadsheets'
-    options.app_name = 'ScraPop'
+    targets = parse_targets(options)
+    if not targets:
+        argparser.error('one of --file-id or --target is required')
 
-    # get list of target cells from google drive
+    try:
+        options.scopes = 'https://www.googleapis.com/auth/spreadsheets'
+        options.app_name = 'ScraPop'
 
-    range_name = "'{sheet}'!{col}:{col}".format(
-        col=options.target_column,
-        sheet=options.target_sheet
-    )
+        shard = None
+        journal_file = options.journal_file
+        if options.shard:
+            shard = ShardUtils.parse_shard(options.shard)
+            journal_file = ShardUtils.shard_path(options.journal_file, *shard)
+            if options.stats_json:
+                options.stats_json = ShardUtils.shard_path(options.stats_json, *shard)
+            if options.stats_prom:
+                options.stats_prom = ShardUtils.shard_path(options.stats_prom, *shard)
+        elif options.shards:
+            with Stats.stage('shards'):
+                ShardUtils.launch(options.shards)
+            options.merge_shards = options.shards
 
-    target_cells = GssUtils.get_range(
-        options.file_id,
-        range_name,
-        options=options,
-        value_render='FORMULA'
-    )
-    # print("target_cells:\n%s" % pformat(target_cells))
-    unique_domains, cell_info = extract_targets(target_cells)
+        UrlUtils.configure_suffix_list(options.suffix_list_file)
 
-    # print("unique_domains:\n%s" % pformat(unique_domains))
+        # get list of target cells from google drive
 
-    metrics = {}
-    # metric_names = ['Rank']
-    metric_names = ['Rank', 'LinksInCount', 'Speed']
+        cell_tables = []
+        with Stats.stage('read_extract'):
+            for target in targets:
+                target_cells = GssUtils.iter_column(
+                    target.file_id,
+                    target.sheet,
+                    target.column,
+                    value_render='FORMULA',
+                    options=options,
+                    window=options.read_window,
+                    concurrency=options.read_concurrency
+                )
+                # print("target_cells:\n%s" % pformat(target_cells))
+                _, cell_info = extract_targets(target_cells)
+                Stats.incr('cells_read', len(cell_info))
+                cell_tables.append(cell_info)
 
-    # TODO: get chunking working in the folliwng comment block:
+        # a single fetch for every target, so domains shared between sheets are
+        # only requested once
+        unique_domains = list(OrderedDict.fromkeys(
+            domain for domain in UrlUtils.only_domains([
+                domain for cell_info in cell_tables for domain in cell_info.domains.names
+            ]) if domain
+        ))
+        Stats.incr('unique_domains', len(unique_domains))
+        if len(targets) > 1:
+            print("%d unique domains across %d targets" % (len(unique_domains), len(targets)))
 
-    chunk_size = 5
-    count = -1
-    for index in range(0, len(unique_domains), chunk_size):
-        count += 1
-        if options.requests_limit and count >= options.requests_limit:
-            print("reached limit")
-            break
-        domains = unique_domains[index:index + chunk_size]
-        domains = [UrlUtils.only_domain(domain) for domain in domains]
-        responses = AwisUtils.get_metrics(domains, metric_names, options)
-        if responses:
-            for domain, response in zip(domains, responses):
-                metrics[domain] = response
-
-    # for count, domain in enumerate(unique_domains):
-    #     # print("count, req_limit: (%s, %s)" % (repr(count), repr(options.requests_limit)))
-    #     if count >= options.requests_limit:
-    #         print("reached limit")
-    #         break
-    #     response = AwisUtils.get_metrics(domain, metric_names, options)
-    #     if response:
-    #         metrics[domain] = response
-
-    # print("metrics:\n%s" % pformat(metrics))
-    for cell_datum in cell_info:
-        if cell_datum.get('domain') and cell_datum['domain'] in metrics:
-            cell_datum.update(metrics[cell_datum['domain']])
+        if shard:
+            unique_domains = ShardUtils.select(unique_domains, *shard)
+            print("shard %d/%d: %d domains" % (shard[0], shard[1], len(unique_domains)))
 
+        # print("unique_domains:\n%s" % pformat(unique_domains))
 
-    report_headers = OrderedDict([
-        ('domain', 'Domain'),
-    ] \
-    + [(metric_name, metric_name) for metric_name in metric_names] \
-    + [
-        ('errors', 'Errors'),
-        ('cell', 'Cell')
-    ])
-    # report_headers = ['domain'] + metric_names + ['errors', 'cell']
+        # metric_names = ['Rank']
+        metric_names = ['Rank', 'LinksInCount', 'Speed']
 
-    with open(options.out_file, 'w+') as report_handle:
-        cell_table = [
-            [info_row.get(header_key) for header_key in report_headers] \
-            for info_row in cell_info
-        ]
-        report_contents = tabulate(cell_table, headers=report_headers, tablefmt="html")
-        report_contents = re.sub("<table>", "<table class=\"table table-striped\">", report_contents)
-        report_contents = "<h1>Metrics Report</h1><p>" + report_contents + "</p>"
-        report_contents = """\
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <!-- Latest compiled and minified CSS -->
-    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" integrity="sha384-1q8mTJOASx8j1Au+a5WDVnPi2lkFfwwEAa8hDDdjZlpLegxhjVME1fgjWPGmkzs7" crossorigin="anonymous">
-
-    <!-- Optional theme -->
-    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap-theme.min.css" integrity="sha384-fLW2N01lMqjakBkx3l/M9EahuwpSfeNvV63J5ezn3uZzapT0u7EYsXMjQV+0En5r" crossorigin="anonymous">
-</head>
-<body>
-    <div class='col-sm-12'>""" + report_contents + """</div>
-    <script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.4/jquery.min.js"></script>
-    <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/js/bootstrap.min.js" integrity="sha384-0mSbJDEHialfmuBBQP6A4Qrprq5OVfW37PRR3j5ELqxss1yVqOtnepnHVP9aJ7xS" crossorigin="anonymous"></script>
-</body>
-</html>
-"""
-        report_handle.write(report_contents)
-        print("wrote report to %s" % options.out_file)
+        cache = None
+        if not options.no_cache:
+            cache = MetricsCache(
+                options.cache_file,
+                ttls=MetricsCache.parse_ttls(options.cache_ttl),
+                refresh=options.refresh_cache
+            )
+
+        rate_limiter = None
+        if options.rate_limit:
+            rate_limiter = TokenBucket(options.rate_limit, options.burst)
+
+        batcher = AdaptiveBatcher(
+            min(options.chunk_size, AwisUtils.max_batch_size),
+            target_latency=options.target_latency
+        )
+
+        AwisUtils.configure(options.key_id, options.secret_key)
+
+        history = None
+        # shards may share a history directory, so the merge records their metrics
+        if options.history_dir and not shard:
+            history = MetricsHistory(options.history_dir)
+
+        journal = RunJournal(journal_file, metric_names)
+        known_metrics = journal.open(resume=options.resume)
+
+        shard_errors = OrderedDict()
+        if options.merge_shards:
+            shard_metrics, shard_errors, shard_fetched = ShardUtils.merge_journals(
+                options.journal_file, options.merge_shards, metric_names
+            )
+            print("merging %d domains and %d errors from %d shards" % (
+                len(shard_metrics), len(shard_errors), options.merge_shards
+            ))
+            if history and shard_fetched:
+                history.record(shard_fetched)
+            known_metrics.update(shard_metrics)
+            # domains which failed in their shard aren't tried again
+            unique_domains = [
+                domain for domain in UrlUtils.only_domains(unique_domains) \
+                if domain not in shard_errors
+            ]
+
+        requests_limit = options.requests_limit or None
+        if requests_limit and shard:
+            requests_limit = ShardUtils.split_limit(requests_limit, *shard)
+        elif requests_limit and options.merge_shards:
+            # the shards have had the whole limit between them
+            requests_limit = 0
+
+        fetcher = MetricsFetcher(
+            metric_names,
+            concurrency=options.concurrency,
+            requests_limit=requests_limit,
+            cache=cache,
+            rate_limiter=rate_limiter,
+            batcher=batcher,
+            max_retries=options.max_retries,
+            journal=journal,
+            history=history
+        )
+        try:
+            with Stats.stage('fetch'):
+                metrics = fetcher.fetch(unique_domains, known_metrics)
+            if shard and fetcher.cache_hits:
+                # the merge needs every result of the shard, but cache hits
+                # aren't new observations for the history
+                journal.append(OrderedDict(
+                    (domain, metrics[domain]) for domain in fetcher.cache_hits
+                ), cached=True)
+        finally:
+            journal.close()
+            if cache:
+                cache.close()
+
+        fetcher.errors.update(shard_errors)
+
+        if shard:
+            print("shard %d/%d: results are in %s" % (shard[0], shard[1], journal_file))
+        else:
+            for target, cell_info in zip(targets, cell_tables):
+                write_results(options, target, cell_info, metrics, fetcher.errors, metric_names)
+    finally:
+        # exported even when the run fails, so failed runs can be monitored
+        if options.stats_json:
+            Stats.write_json(options.stats_json)
+        if options.stats_prom:
+            Stats.write_prometheus(options.stats_prom)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent fetching of popularity metrics from the AWIS API.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import httplib
+import random
+import socket
+import sys
+import threading
+import time
+import Queue
+
+from scrapop.records import MetricTable
+from scrapop.stats import Stats
+from scrapop.utils import AwisUtils, AwisError, AwisAuthError, UrlUtils
+
+
+class RequestsLimitReached(UserWarning):
+    """
+    Raised instead of making a request once the requests limit is used up.
+    """
+
+
+class MetricsFetcher(object):
+    """
+    Fetches metrics for a list of domains in chunks, keeping several chunks in
+    flight at once.
+
+    Chunks are merged in the order they were submitted, regardless of the
+    order in which their requests complete, so the result is the same as
+    fetching the chunks one after the other.
+    """
+
+    chunk_size = AwisUtils.max_batch_size
+    transient_errors = (IOError, socket.error, httplib.HTTPException)
+
+    def __init__(self, metric_names, concurrency=1, requests_limit=None,
+                 cache=None, rate_limiter=None, batcher=None, max_retries=3,
+                 backoff_base=1.0, backoff_max=60.0, journal=None, history=None):
+        import httplib2
+        # httplib2 is slow to import, so it isn't until there's a fetch to do
+        self.transient_errors = self.transient_errors + (httplib2.HttpLib2Error,)
+        self.metric_names = metric_names
+        self.concurrency = max(1, concurrency or 1)
+        self.requests_limit = requests_limit
+        self.cache = cache
+        self.journal = journal
+        self.history = history
+        self.rate_limiter = rate_limiter
+        self.batcher = batcher
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests_made = 0
+        self._requests_lock = threading.Lock()
+        self.errors = OrderedDict()
+        # domains whose metrics came from the cache rather than AWIS
+        self.cache_hits = []
+        self.latencies = []
+        self.fetched_count = 0
+        self.elapsed = 0.0
+
+    @property
+    def domains_per_sec(self):
+        """The effective rate at which domains were fetched from the API."""
+        if not self.elapsed:
+            return 0.0
+        return self.fetched_count / self.elapsed
+
+    def iter_chunks(self, domains):
+        """
+        Yield consecutive chunks of domains to be requested together.
+
+        The size of each chunk is decided when it is requested, so that it
+        follows the batcher's latest estimate.
+        """
+        index = 0
+        while index < len(domains):
+            size = self.batcher.size if self.batcher else self.chunk_size
+            yield domains[index:index + size]
+            index += size
+
+    @classmethod
+    def normalize_domains(cls, domains):
+        """
+        Reduce domains to the form requested from AWIS, dropping duplicates.
+        """
+        normalized = OrderedDict()
+        for domain in UrlUtils.only_domains(domains):
+            normalized[domain] = None
+        return normalized.keys()
+
+    @property
+    def limit_reached(self):
+        """Whether every request allowed by the requests limit has been made."""
+        return self.requests_limit is not None and self.requests_made >= self.requests_limit
+
+    def reserve_request(self):
+        """
+        Count a request against the requests limit, shared by all workers.
+
+        Raises:
+            RequestsLimitReached: if the limit has already been used up.
+        """
+        with self._requests_lock:
+            if self.limit_reached:
+                raise RequestsLimitReached('requests limit reached')
+            self.requests_made += 1
+
+    def request_chunk(self, domains):
+        """
+        Make a single, paced request for the metrics of a chunk of domains.
+
+        Every request counts against the requests limit, including retries and
+        the requests for halves of a chunk.
+
+        Returns:
+            list: dicts of metric values in the same order as domains.
+        """
+        self.reserve_request()
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        start = time.time()
+        Stats.incr('awis_requests')
+        try:
+            responses = AwisUtils.get_metrics(domains, self.metric_names)
+        except Exception:
+            Stats.incr('awis_request_errors')
+            if self.batcher:
+                self.batcher.record(time.time() - start, error=True)
+            raise
+        latency = time.time() - start
+        self.latencies.append(latency)
+        Stats.observe('awis_latency_seconds', latency)
+        if self.batcher:
+            self.batcher.record(latency)
+        return responses or []
+
+    def backoff_delay(self, attempt):
+        """
+        Seconds to wait before retry number `attempt`, with full jitter.
+        """
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def request_with_retries(self, domains):
+        """
+        Request a chunk, retrying transient failures with exponential backoff.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.request_chunk(domains)
+            except self.transient_errors:
+                if attempt >= self.max_retries:
+                    raise
+                Stats.incr('awis_retries')
+                time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+
+    def fetch_chunk(self, domains):
+        """
+        Fetch metrics for a single chunk of domains.
+
+        If AWIS can't provide metrics for the whole chunk, the chunk is split in
+        half and each half is fetched separately, so that only the domains that
+        are actually at fault are dropped. Authorization failures affect every
+        request, so they abort the fetch instead. Domains left unrequested when
+        the requests limit runs out are recorded as errors.
+
+        Returns:
+            tuple: a list of (domain, response) pairs, and a dict of domain to
+                error message for the domains which could not be fetched.
+        """
+        try:
+            responses = self.request_with_retries(domains)
+        except self.transient_errors as exc:
+            message = 'gave up after %d retries: %s' % (self.max_retries, exc)
+            return [], dict((domain, message) for domain in domains)
+        except RequestsLimitReached as exc:
+            return [], dict((domain, str(exc)) for domain in domains)
+        except AwisAuthError:
+            raise
+        except AwisError as exc:
+            Stats.incr('awis_bisections')
+            if len(domains) == 1:
+                return [], {domains[0]: str(exc)}
+            middle = len(domains) // 2
+            pairs, errors = self.fetch_chunk(domains[:middle])
+            right_pairs, right_errors = self.fetch_chunk(domains[middle:])
+            pairs.extend(right_pairs)
+            errors.update(right_errors)
+            return pairs, errors
+        return zip(domains, responses), {}
+
+    def _run_chunk(self, results, seq, domains):
+        """
+        Worker entry point, reports the outcome of a chunk on the results queue.
+        """
+        try:
+            results.put((seq, self.fetch_chunk(domains), None))
+        except Exception:
+            results.put((seq, None, sys.exc_info()))
+
+    def fetch(self, domains, known_metrics=None):
+        """
+        Fetch metrics for all domains, stopping at the requests limit.
+
+        Domains in known_metrics or with fresh values in the cache are not
+        requested, and do not count towards the requests limit. Domains which
+        could not be fetched, or were not requested because the limit was
+        reached, are recorded in `errors` instead of aborting the fetch.
+
+        Args:
+            domains (list): The domains to get metrics for.
+            known_metrics (dict): mapping of domain to metrics already fetched,
+                e.g. by a previous attempt at this run.
+
+        Returns:
+            MetricTable: the metrics fetched for each domain.
+        """
+        metrics = MetricTable(self.metric_names)
+        domains = self.normalize_domains(domains)
+        if known_metrics:
+            for domain in domains:
+                if domain in known_metrics:
+                    metrics.set(domain, known_metrics[domain])
+            domains = [domain for domain in domains if domain not in known_metrics]
+            Stats.incr('journal_resumed_domains', len(metrics))
+        if self.cache:
+            with Stats.stage('cache_read'):
+                cached = self.cache.get_many(domains, self.metric_names)
+            for domain in domains:
+                if domain in cached:
+                    metrics.set(domain, cached[domain])
+                    self.cache_hits.append(domain)
+            domains = [domain for domain in domains if domain not in cached]
+            Stats.incr('cache_hits', len(cached))
+            Stats.incr('cache_misses', len(domains))
+            print("cache hits: %d, to fetch: %d" % (len(cached), len(domains)))
+
+        results = Queue.Queue()
+        chunks = self.iter_chunks(domains)
+        completed = {}
+        submitted = 0
+        merged = 0
+        exhausted = False
+        skipped = []
+
+        start = time.time()
+        pool = ThreadPool(self.concurrency)
+        try:
+            while True:
+                while not exhausted and submitted - merged - len(completed) < self.concurrency:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    if self.limit_reached:
+                        print("reached limit")
+                        skipped.extend(chunk)
+                        for rest in chunks:
+                            skipped.extend(rest)
+                        exhausted = True
+                        break
+                    pool.apply_async(self._run_chunk, (results, submitted, chunk))
+                    submitted += 1
+
+                if merged == submitted:
+                    break
+
+                seq, outcome, exc_info = results.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                completed[seq] = outcome
+                while merged in completed:
+                    pairs, errors = completed.pop(merged)
+                    self.errors.update(errors)
+                    fetched = OrderedDict(pairs)
+                    metrics.update(fetched)
+                    self.fetched_count += len(fetched)
+                    Stats.incr('domains_fetched', len(fetched))
+                    Stats.incr('domains_failed', len(errors))
+                    if self.cache and fetched:
+                        with Stats.stage('cache_write'):
+                            self.cache.set_many(fetched)
+                    if self.journal:
+                        with Stats.stage('journal_write'):
+                            self.journal.append(fetched, errors)
+                    if self.history and fetched:
+                        with Stats.stage('history_write'):
+                            self.history.record(fetched)
+                    merged += 1
+        finally:
+            pool.terminate()
+            pool.join()
+            self.elapsed += time.time() - start
+
+        if skipped:
+            errors = OrderedDict((domain, 'requests limit reached') for domain in skipped)
+            self.errors.update(errors)
+            Stats.incr('domains_failed', len(errors))
+            if self.journal:
+                self.journal.append({}, errors)
+
+        print("fetched %d domains in %.2fs (%.2f domains/sec), %d failed" % (
+            self.fetched_count, self.elapsed, self.domains_per_sec, len(self.errors)
+        ))
+
+        return metrics
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only history of metric values, for reporting trends without
+re-querying AWIS.
+"""
+
+from __future__ import print_function
+from array import array
+from collections import OrderedDict
+import math
+import os
+
+import configargparse
+
+from scrapop.utils import TimeHelpers
+
+
+class MetricsHistory(object):
+    """
+    Columnar store of (domain, metric, tsecs, value) observations.
+
+    Each column is a flat file of fixed width values which is only ever
+    appended to, so recording is cheap and queries can memory-map the
+    columns. Domain and metric names are interned into ids, kept in text
+    files with one name per line.
+
+    Queries need numpy.
+    """
+
+    # column name, array typecode, numpy dtype
+    columns = [
+        ('value', 'd', 'f8'),
+        ('tsecs', 'd', 'f8'),
+        ('metric_id', 'i', 'i4'),
+        ('domain_id', 'i', 'i4'),
+    ]
+    domains_file = 'domains.txt'
+    metrics_file = 'metrics.txt'
+
+    def __init__(self, path):
+        """
+        Args:
+            path (basestring): Directory holding the history.
+        """
+        self.path = os.path.expanduser(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.domains = self._load_names(self.domains_file)
+        self.metrics = self._load_names(self.metrics_file)
+        self.domain_ids = dict((name, index) for index, name in enumerate(self.domains))
+        self.metric_ids = dict((name, index) for index, name in enumerate(self.metrics))
+
+    def _load_names(self, filename):
+        names_path = os.path.join(self.path, filename)
+        if not os.path.exists(names_path):
+            return []
+        with open(names_path) as names_handle:
+            return [line.rstrip('\n').decode('utf-8') for line in names_handle]
+
+    def _intern(self, name, names, ids, new_names):
+        if name in ids:
+            return ids[name]
+        ids[name] = len(names)
+        names.append(name)
+        new_names.append(name)
+        return ids[name]
+
+    def _append_names(self, filename, new_names):
+        if not new_names:
+            return
+        with open(os.path.join(self.path, filename), 'a') as names_handle:
+            names_handle.write(''.join(name.encode('utf-8') + '\n' for name in new_names))
+
+    def column_path(self, column):
+        """Get the location of a column's file."""
+        return os.path.join(self.path, column + '.col')
+
+    def _trim_columns(self):
+        """
+        Cut every column back to the rows which made it into all of them, so
+        a record that was interrupted part way through doesn't shift the
+        columns against each other.
+        """
+        sizes = []
+        for column, typecode, _ in self.columns:
+            column_path = self.column_path(column)
+            size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+            sizes.append((column_path, size, array(typecode).itemsize))
+        length = min(size // itemsize for _, size, itemsize in sizes)
+        for column_path, size, itemsize in sizes:
+            if size > length * itemsize:
+                with open(column_path, 'r+b') as column_handle:
+                    column_handle.truncate(length * itemsize)
+
+    @classmethod
+    def to_number(cls, value):
+        """Convert a metric value to a float, or None if it isn't numeric."""
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        if math.isnan(number):
+            return None
+        return number
+
+    def record(self, metrics, tsecs=None):
+        """
+        Append observations of metrics, skipping values that aren't numeric.
+
+        Args:
+            metrics (dict): mapping of domain to a dict of metric values.
+            tsecs (float): When the values were observed, defaults to now.
+
+        Returns:
+            int: The number of observations recorded.
+        """
+        if tsecs is None:
+            tsecs = TimeHelpers.current_tsecs()
+        rows = {
+            'value': array('d'),
+            'tsecs': array('d'),
+            'metric_id': array('i'),
+            'domain_id': array('i'),
+        }
+        new_metrics = []
+        new_domains = []
+        for domain, domain_metrics in metrics.items():
+            for metric, value in domain_metrics.items():
+                number = self.to_number(value)
+                if number is None:
+                    continue
+                rows['value'].append(number)
+                rows['tsecs'].append(tsecs)
+                rows['metric_id'].append(self._intern(
+                    metric, self.metrics, self.metric_ids, new_metrics
+                ))
+                rows['domain_id'].append(self._intern(
+                    domain, self.domains, self.domain_ids, new_domains
+                ))
+        # names are written before the rows which refer to them
+        self._append_names(self.metrics_file, new_metrics)
+        self._append_names(self.domains_file, new_domains)
+        # readers ignore rows missing from any column, and the next record
+        # trims them
+        self._trim_columns()
+        for column, _, _ in self.columns:
+            with open(self.column_path(column), 'ab') as column_handle:
+                rows[column].tofile(column_handle)
+        return len(rows['value'])
+
+    def load(self):
+        """
+        Memory-map the columns.
+
+        Returns:
+            dict: mapping of column name to a read only numpy array.
+        """
+        try:
+            #pylint: disable=import-error
+            import numpy
+        except ImportError:
+            raise UserWarning('numpy is required to query the metrics history')
+        arrays = {}
+        for column, _, dtype in self.columns:
+            column_path = self.column_path(column)
+            if not os.path.exists(column_path) or not os.path.getsize(column_path):
+                arrays[column] = numpy.zeros(0, dtype=dtype)
+            else:
+                arrays[column] = numpy.memmap(column_path, dtype=dtype, mode='r')
+        length = min(len(values) for values in arrays.values())
+        return dict((column, values[:length]) for column, values in arrays.items())
+
+    def latest(self, metric, before=None):
+        """
+        Get the most recent value of a metric for every domain.
+
+        Args:
+            metric (basestring): The metric name.
+            before (float): Only consider observations at or before this time.
+
+        Returns:
+            tuple: numpy arrays of domain ids and their latest values.
+        """
+        import numpy
+        arrays = self.load()
+        if metric not in self.metric_ids:
+            return numpy.zeros(0, dtype='i4'), numpy.zeros(0, dtype='f8')
+        selected = arrays['metric_id'] == self.metric_ids[metric]
+        if before is not None:
+            selected &= arrays['tsecs'] <= before
+        domain_ids = arrays['domain_id'][selected]
+        tsecs = arrays['tsecs'][selected]
+        values = arrays['value'][selected]
+        # sort by domain, then time, and take the last of each domain
+        order = numpy.lexsort((tsecs, domain_ids))
+        domain_ids, values = domain_ids[order], values[order]
+        last = numpy.ones(len(domain_ids), dtype=bool)
+        last[:-1] = domain_ids[1:] != domain_ids[:-1]
+        return domain_ids[last], values[last]
+
+    def delta(self, metric, days=30, now=None):
+        """
+        Get the change in a metric for every domain over a number of days.
+
+        The change is between the latest value and the latest value observed
+        at least `days` ago, domains without both are left out.
+
+        Returns:
+            OrderedDict: mapping of domain to (then, now, delta), ordered by
+                domain id.
+        """
+        import numpy
+        if now is None:
+            now = TimeHelpers.current_tsecs()
+        current_ids, current_values = self.latest(metric, before=now)
+        past_ids, past_values = self.latest(metric, before=now - days * 24 * 60 * 60)
+
+        past = numpy.full(len(self.domains), numpy.nan)
+        past[past_ids] = past_values
+        current = numpy.full(len(self.domains), numpy.nan)
+        current[current_ids] = current_values
+        both = numpy.flatnonzero(~numpy.isnan(past) & ~numpy.isnan(current))
+        deltas = current[both] - past[both]
+
+        return OrderedDict(
+            (self.domains[domain_id], (past[domain_id], current[domain_id], delta)) \
+            for domain_id, delta in zip(both, deltas)
+        )
+
+
+def main():
+    """Print the change in a metric for every domain in the history."""
+
+    argparser = configargparse.ArgumentParser(
+        description="Report trends in stored popularity metrics"
+    )
+    argparser.add_argument(
+        '--history-dir',
+        help='Location of the metrics history',
+        required=True,
+        metavar='DIR'
+    )
+    argparser.add_argument(
+        '--metric',
+        help='The metric to report on',
+        default='Rank'
+    )
+    argparser.add_argument(
+        '--days',
+        type=float,
+        help='The period to report the change over',
+        default=30
+    )
+    options = argparser.parse_args()
+
+    history = MetricsHistory(options.history_dir)
+    for domain, (then, now, delta) in history.delta(options.metric, options.days).items():
+        print("%s\t%s\t%s\t%+g" % (domain, then, now, delta))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointing of long scraping runs.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import json
+import os
+
+from scrapop.utils import TimeHelpers
+
+
+class RunJournal(object):
+    """
+    Append-only journal of the chunks completed during a run.
+
+    Each line is a JSON object holding the metrics and errors of one chunk, so
+    a run that dies part way through can be resumed without re-fetching the
+    domains it already has.
+    """
+
+    def __init__(self, path, metric_names):
+        """
+        Args:
+            path (basestring): Location of the journal file.
+            metric_names (list): The metrics fetched in this run.
+        """
+        self.path = os.path.expanduser(path)
+        self.metric_names = list(metric_names)
+        self.handle = None
+
+    def load(self, fetched_only=False):
+        """
+        Read the metrics recorded by a previous run.
+
+        Domains missing any of this run's metrics are left out, as is a
+        truncated final line.
+
+        Args:
+            fetched_only (bool): Leave out entries of metrics which came from
+                the cache.
+
+        Returns:
+            OrderedDict: mapping of domain to metrics.
+        """
+        metrics = OrderedDict()
+        for entry in self.iter_entries():
+            if fetched_only and entry.get('cached'):
+                continue
+            for domain, domain_metrics in entry.get('metrics', {}).items():
+                if all(metric in domain_metrics for metric in self.metric_names):
+                    metrics[domain] = domain_metrics
+        return metrics
+
+    def load_errors(self):
+        """
+        Read the errors recorded by a previous run.
+
+        Returns:
+            OrderedDict: mapping of domain to the reason it could not be
+                fetched, for domains without metrics in the journal.
+        """
+        errors = OrderedDict()
+        for entry in self.iter_entries():
+            for domain in entry.get('metrics', {}):
+                errors.pop(domain, None)
+            errors.update(entry.get('errors', {}))
+        return errors
+
+    def iter_entries(self):
+        """Yield each complete entry in the journal."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal_handle:
+            for line in journal_handle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def trim(self):
+        """
+        Cut off a final line left incomplete by a run that died while writing
+        it, so entries appended after it start on a line of their own.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r+b') as journal_handle:
+            journal_handle.seek(0, os.SEEK_END)
+            end = position = journal_handle.tell()
+            while position > 0:
+                start = max(0, position - 4096)
+                journal_handle.seek(start)
+                newline = journal_handle.read(position - start).rfind('\n')
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position < end:
+                journal_handle.truncate(position)
+
+    def open(self, resume=False):
+        """
+        Open the journal for writing.
+
+        Args:
+            resume (bool): Keep the entries of a previous run, otherwise the
+                journal is started afresh.
+
+        Returns:
+            OrderedDict: the metrics already recorded if resuming.
+        """
+        metrics = OrderedDict()
+        if resume:
+            self.trim()
+            metrics = self.load()
+            print("resuming with %d domains from %s" % (len(metrics), self.path))
+        journal_dir = os.path.dirname(self.path)
+        if journal_dir and not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        self.handle = open(self.path, 'a' if resume else 'w')
+        return metrics
+
+    def append(self, metrics, errors=None, cached=False):
+        """
+        Record a completed chunk, flushed to disk before returning.
+
+        Args:
+            metrics (dict): mapping of domain to the metrics fetched for it.
+            errors (dict): mapping of domain to the reason it could not be
+                fetched.
+            cached (bool): Whether the metrics came from the cache rather
+                than being fetched.
+        """
+        entry = {
+            'tsecs': TimeHelpers.current_tsecs(),
+            'metrics': metrics,
+            'errors': errors or {},
+        }
+        if cached:
+            entry['cached'] = True
+        self.handle.write(json.dumps(entry) + "\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        """Close the journal."""
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented tables of target cells and fetched metrics.
+
+A dict per cell and per domain costs hundreds of bytes each, which adds up to
+gigabytes on sheets with millions of rows. These tables keep each field in its
+own typed array instead, with domain names interned to integer ids.
+"""
+
+from array import array
+import math
+
+
+class NameIndex(object):
+    """
+    Interns names to consecutive integer ids, in the order they were first
+    seen.
+    """
+
+    __slots__ = ('names', 'ids')
+
+    def __init__(self, names=None):
+        self.names = []
+        self.ids = {}
+        for name in names or []:
+            self.intern(name)
+
+    def intern(self, name):
+        """Get the id of a name, adding it if it is new."""
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def get_id(self, name, default=-1):
+        """Get the id of a name, or default if it hasn't been seen."""
+        return self.ids.get(name, default)
+
+    def __getitem__(self, name_id):
+        return self.names[name_id]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+class CellTable(object):
+    """
+    The target cells of a sheet: the row each came from, its value, the id of
+    the domain extracted from it, and the id of the error if there wasn't one.
+    Missing ids are -1.
+    """
+
+    __slots__ = ('domains', 'error_names', 'rows', 'cells', 'domain_ids', 'error_ids')
+
+    def __init__(self):
+        self.domains = NameIndex()
+        self.error_names = NameIndex()
+        self.rows = array('l')
+        self.cells = []
+        self.domain_ids = array('l')
+        self.error_ids = array('l')
+
+    def append(self, row, cell, domain=None, error=None):
+        """Add a cell, with either the domain extracted or the error."""
+        self.rows.append(row)
+        self.cells.append(cell)
+        self.domain_ids.append(-1 if domain is None else self.domains.intern(domain))
+        self.error_ids.append(-1 if error is None else self.error_names.intern(error))
+
+    def get_domain(self, index):
+        """Get the domain of the cell at index, or None."""
+        domain_id = self.domain_ids[index]
+        return None if domain_id < 0 else self.domains[domain_id]
+
+    def get_error(self, index):
+        """Get the extraction error of the cell at index, or None."""
+        error_id = self.error_ids[index]
+        return None if error_id < 0 else self.error_names[error_id]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class MetricTable(object):
+    """
+    Metric values of many domains, one array of floats per metric indexed by
+    domain id. NaN marks a missing value.
+
+    Non-numeric values are rare, they are kept to one side in a dict. Values
+    are handed back as ints where they are whole, which is how AWIS reports
+    all of its metrics.
+
+    Supports enough of the dict interface, e.g. `domain in table` and
+    `table[domain]`, to stand in for a mapping of domain to metrics.
+    """
+
+    __slots__ = ('metric_names', 'domains', 'columns', 'present', 'texts')
+
+    def __init__(self, metric_names):
+        self.metric_names = list(metric_names)
+        self.domains = NameIndex()
+        self.columns = [array('d') for _ in self.metric_names]
+        self.present = bytearray()
+        self.texts = {}
+
+    def set(self, domain, domain_metrics):
+        """Store the metrics of a domain, replacing any already stored."""
+        domain_id = self.domains.intern(domain)
+        if domain_id == len(self.present):
+            self.present.append(0)
+            for column in self.columns:
+                column.append(float('nan'))
+        self.present[domain_id] = 1
+        for metric_index, (metric, column) in enumerate(zip(self.metric_names, self.columns)):
+            value = domain_metrics.get(metric)
+            self.texts.pop((domain_id, metric_index), None)
+            try:
+                column[domain_id] = float('nan') if value is None else float(value)
+            except (TypeError, ValueError):
+                column[domain_id] = float('nan')
+                self.texts[(domain_id, metric_index)] = value
+
+    def update(self, metrics):
+        """Store the metrics of several domains, from a mapping or a table."""
+        for domain, domain_metrics in metrics.items():
+            self.set(domain, domain_metrics)
+
+    def get_values(self, domain_id):
+        """
+        Get the values of a domain by id, in the order of metric_names, with
+        None for missing values.
+        """
+        values = []
+        for metric_index, column in enumerate(self.columns):
+            value = column[domain_id]
+            if math.isnan(value):
+                values.append(self.texts.get((domain_id, metric_index)))
+            elif value.is_integer():
+                values.append(int(value))
+            else:
+                values.append(value)
+        return values
+
+    def get_ids(self, domains):
+        """Get the id of each domain which has metrics, or -1."""
+        return array('l', [
+            domain_id if domain_id >= 0 and self.present[domain_id] else -1 \
+            for domain_id in (self.domains.get_id(domain) for domain in domains)
+        ])
+
+    def __contains__(self, domain):
+        domain_id = self.domains.get_id(domain)
+        return domain_id >= 0 and bool(self.present[domain_id])
+
+    def __getitem__(self, domain):
+        domain_id = self.domains.get_id(domain)
+        if domain_id < 0 or not self.present[domain_id]:
+            raise KeyError(domain)
+        return dict(zip(self.metric_names, self.get_values(domain_id)))
+
+    def get(self, domain, default=None):
+        """Get the metrics of a domain as a dict, or default."""
+        try:
+            return self[domain]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """The domains with metrics, in the order they were first stored."""
+        return [
+            domain for domain, present in zip(self.domains.names, self.present) if present
+        ]
+
+    def items(self):
+        """Pairs of domain and a dict of its metrics."""
+        return [(domain, self[domain]) for domain in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(self.present)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Writers which stream metrics reports to a file one row at a time.
+"""
+
+from __future__ import print_function
+from cgi import escape as html_escape
+from collections import OrderedDict
+import csv
+import gzip
+import json
+import os
+
+
+class ReportWriter(object):
+    """
+    Abstract report writer.
+
+    Subclasses write a header, then each row as it is given, then a footer, so
+    that memory use does not depend on the number of rows.
+    """
+
+    format_name = None
+    extensions = ()
+    # whether the format applies compression itself rather than the file
+    compresses_internally = False
+
+    def __init__(self, handle, headers, compress=None):
+        """
+        Args:
+            handle (file): Binary file to write to.
+            headers (OrderedDict): mapping of row keys to column titles.
+            compress (basestring): Compression codec, only used by formats
+                that compress internally.
+        """
+        self.handle = handle
+        self.headers = headers
+        self.compress = compress
+        self.row_count = 0
+
+    def write_header(self):
+        """Write anything that comes before the rows."""
+        pass
+
+    def write_row(self, row):
+        """Write a single row, a list of values in the order of headers."""
+        raise NotImplementedError()
+
+    def write_footer(self):
+        """Write anything that comes after the rows."""
+        pass
+
+    def write_rows(self, rows):
+        """Write a whole report from an iterable of rows."""
+        self.write_header()
+        for row in rows:
+            self.write_row(row)
+            self.row_count += 1
+        self.write_footer()
+        return self.row_count
+
+    @classmethod
+    def to_bytes(cls, value):
+        """Convert a cell value to utf-8 bytes, None becomes blank."""
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+
+class HtmlReportWriter(ReportWriter):
+    """Writes a bootstrap styled html table."""
+
+    format_name = 'html'
+    extensions = ('.html', '.htm')
+
+    header_template = """\
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <!-- Latest compiled and minified CSS -->
+    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap.min.css" integrity="sha384-1q8mTJOASx8j1Au+a5WDVnPi2lkFfwwEAa8hDDdjZlpLegxhjVME1fgjWPGmkzs7" crossorigin="anonymous">
+
+    <!-- Optional theme -->
+    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/css/bootstrap-theme.min.css" integrity="sha384-fLW2N01lMqjakBkx3l/M9EahuwpSfeNvV63J5ezn3uZzapT0u7EYsXMjQV+0En5r" crossorigin="anonymous">
+</head>
+<body>
+    <div class='col-sm-12'><h1>Metrics Report</h1><p><table class="table table-striped">
+<thead>
+<tr>%s</tr>
+</thead>
+<tbody>
+"""
+    footer_template = """\
+</tbody>
+</table></p></div>
+    <script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.4/jquery.min.js"></script>
+    <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.6/js/bootstrap.min.js" integrity="sha384-0mSbJDEHialfmuBBQP6A4Qrprq5OVfW37PRR3j5ELqxss1yVqOtnepnHVP9aJ7xS" crossorigin="anonymous"></script>
+</body>
+</html>
+"""
+
+    def write_header(self):
+        self.handle.write(self.header_template % ''.join(
+            '<th>%s</th>' % html_escape(self.to_bytes(title)) \
+            for title in self.headers.values()
+        ))
+
+    def write_row(self, row):
+        self.handle.write('<tr>%s</tr>\n' % ''.join(
+            '<td>%s</td>' % html_escape(self.to_bytes(value)) for value in row
+        ))
+
+    def write_footer(self):
+        self.handle.write(self.footer_template)
+
+
+class CsvReportWriter(ReportWriter):
+    """Writes comma separated values with a header row."""
+
+    format_name = 'csv'
+    extensions = ('.csv',)
+
+    def __init__(self, handle, headers, compress=None):
+        super(CsvReportWriter, self).__init__(handle, headers, compress)
+        self.writer = csv.writer(handle)
+
+    def write_header(self):
+        self.writer.writerow([self.to_bytes(title) for title in self.headers.values()])
+
+    def write_row(self, row):
+        self.writer.writerow([self.to_bytes(value) for value in row])
+
+
+class JsonlReportWriter(ReportWriter):
+    """Writes one JSON object per row, keyed by the header keys."""
+
+    format_name = 'jsonl'
+    extensions = ('.jsonl', '.jl')
+
+    def write_row(self, row):
+        self.handle.write(json.dumps(OrderedDict(zip(self.headers.keys(), row))) + "\n")
+
+
+class ParquetReportWriter(ReportWriter):
+    """
+    Writes a parquet file, a row group at a time.
+
+    Requires pyarrow. Columns are stored as strings, since a report column
+    can mix metric values with blanks.
+    """
+
+    format_name = 'parquet'
+    extensions = ('.parquet',)
+    compresses_internally = True
+    row_group_size = 10000
+
+    def __init__(self, handle, headers, compress=None):
+        super(ParquetReportWriter, self).__init__(handle, headers, compress)
+        try:
+            #pylint: disable=import-error
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise UserWarning('pyarrow is required to write parquet reports')
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            pyarrow.field(key, pyarrow.string()) for key in headers.keys()
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            handle, self.schema, compression=compress or 'snappy'
+        )
+        self.columns = [[] for _ in headers]
+
+    def flush(self):
+        """Write the buffered rows as a row group."""
+        if not self.columns[0]:
+            return
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(column, type=self.pyarrow.string()) for column in self.columns],
+            schema=self.schema
+        ))
+        self.columns = [[] for _ in self.headers]
+
+    def write_row(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(None if value is None else self.to_bytes(value).decode('utf-8'))
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def write_footer(self):
+        self.flush()
+        self.writer.close()
+
+
+REPORT_WRITERS = [
+    HtmlReportWriter,
+    CsvReportWriter,
+    JsonlReportWriter,
+    ParquetReportWriter,
+]
+
+
+class ReportUtils(object):
+    """
+    Utilities for choosing and running report writers.
+    """
+
+    formats = [writer.format_name for writer in REPORT_WRITERS]
+
+    @classmethod
+    def get_writer_class(cls, path, fmt=None):
+        """
+        Get the writer for a format, or guess it from the path's extension.
+        """
+        for writer in REPORT_WRITERS:
+            if writer.format_name == fmt:
+                return writer
+        if fmt:
+            raise UserWarning('unknown report format %s' % fmt)
+        root, ext = os.path.splitext(path)
+        if ext == '.gz':
+            _, ext = os.path.splitext(root)
+        for writer in REPORT_WRITERS:
+            if ext.lower() in writer.extensions:
+                return writer
+        return HtmlReportWriter
+
+    @classmethod
+    def write_report(cls, path, headers, rows, fmt=None, compress=None):
+        """
+        Stream rows to a report file.
+
+        Args:
+            path (basestring): Location of the report.
+            headers (OrderedDict): mapping of row keys to column titles.
+            rows (iterable): lists of values in the order of headers.
+            fmt (basestring): One of formats, guessed from path if None.
+            compress (basestring): 'gzip' to compress the report, implied by a
+                .gz extension.
+
+        Returns:
+            int: The number of rows written.
+        """
+        writer_class = cls.get_writer_class(path, fmt)
+        if compress is None and path.endswith('.gz'):
+            compress = 'gzip'
+        if compress == 'gzip' and not writer_class.compresses_internally:
+            handle = gzip.open(path, 'wb')
+        elif compress and compress != 'gzip':
+            raise UserWarning('unknown report compression %s' % compress)
+        else:
+            handle = open(path, 'wb')
+        with handle:
+            return writer_class(handle, headers, compress).write_rows(rows)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting a run's domains into shards, which can be fetched by separate
+processes or hosts and merged afterwards.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import os
+import subprocess
+import sys
+import zlib
+
+from scrapop.journal import RunJournal
+from scrapop.utils import UrlUtils
+
+
+class ShardUtils(object):
+    """
+    Utilities for sharded runs.
+
+    A domain's shard is a stable hash of its normalized form, so every
+    process agrees on it no matter which cells the domain came from. Each
+    shard records its results in its own journal, which the merge reads back
+    instead of fetching.
+    """
+
+    @classmethod
+    def parse_shard(cls, spec):
+        """
+        Parse a shard spec like "2/8" into (index, count), index counting
+        from 0.
+        """
+        index, _, count = spec.partition('/')
+        try:
+            index, count = int(index), int(count)
+        except ValueError:
+            raise UserWarning('invalid shard %s, expected INDEX/COUNT' % repr(spec))
+        if count < 1 or not 0 <= index < count:
+            raise UserWarning('invalid shard %s, expected 0 <= INDEX < COUNT' % repr(spec))
+        return index, count
+
+    @classmethod
+    def shard_of(cls, domain, count):
+        """Get the shard a normalized domain belongs to."""
+        if isinstance(domain, unicode):
+            domain = domain.encode('utf-8')
+        return (zlib.crc32(domain) & 0xffffffff) % count
+
+    @classmethod
+    def select(cls, domains, index, count):
+        """
+        Get the normalized domains which belong to a shard, in order.
+        """
+        return [
+            domain for domain in OrderedDict.fromkeys(UrlUtils.only_domains(domains)) \
+            if domain and cls.shard_of(domain, count) == index
+        ]
+
+    @classmethod
+    def split_limit(cls, limit, index, count):
+        """
+        Get a shard's share of a limit, so the shards' shares add up to it.
+        """
+        return limit // count + (1 if index < limit % count else 0)
+
+    @classmethod
+    def shard_path(cls, path, index, count):
+        """Get the location of a shard's copy of a file."""
+        root, ext = os.path.splitext(path)
+        return '%s.shard-%d-of-%d%s' % (root, index, count, ext)
+
+    @classmethod
+    def worker_args(cls, argv, index, count):
+        """
+        Get the arguments for a shard worker from the launcher's arguments.
+        """
+        args = []
+        skip = False
+        for arg in argv:
+            if skip:
+                skip = False
+                continue
+            if arg == '--shards':
+                skip = True
+                continue
+            if arg.startswith('--shards='):
+                continue
+            args.append(arg)
+        return args + ['--shard', '%d/%d' % (index, count)]
+
+    @classmethod
+    def launch(cls, count, argv=None):
+        """
+        Run a worker process for each shard on this host and wait for them.
+
+        Args:
+            count (int): The number of shards.
+            argv (list): The launcher's command line arguments.
+        """
+        if argv is None:
+            argv = sys.argv[1:]
+        workers = [
+            subprocess.Popen(
+                [sys.executable, '-m', 'scrapop.core'] + cls.worker_args(argv, index, count)
+            ) \
+            for index in range(count)
+        ]
+        failed = [
+            index for index, worker in enumerate(workers) if worker.wait() != 0
+        ]
+        if failed:
+            raise UserWarning('shards %s failed' % ', '.join(str(index) for index in failed))
+
+    @classmethod
+    def merge_journals(cls, path, count, metric_names):
+        """
+        Read back the results of every shard.
+
+        Args:
+            path (basestring): The unsharded journal location.
+            count (int): The number of shards.
+            metric_names (list): The metrics fetched in the run.
+
+        Returns:
+            tuple: OrderedDicts of domain to metrics, domain to error, and
+                domain to the metrics which were fetched rather than read from
+                the cache.
+        """
+        metrics = OrderedDict()
+        errors = OrderedDict()
+        fetched = OrderedDict()
+        for index in range(count):
+            journal = RunJournal(cls.shard_path(path, index, count), metric_names)
+            if not os.path.exists(journal.path):
+                print("missing results for shard %d/%d: %s" % (index, count, journal.path))
+                continue
+            metrics.update(journal.load())
+            fetched.update(journal.load(fetched_only=True))
+            errors.update(journal.load_errors())
+        for domain in metrics:
+            errors.pop(domain, None)
+        return metrics, errors, fetched
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Timers, counters and histograms describing a run, with JSON and Prometheus
+textfile export.
+"""
+
+from __future__ import print_function
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import re
+import threading
+import time
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds.
+    """
+
+    default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record a single value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        """Get (upper bound, count of values <= bound) pairs, ending with +Inf."""
+        pairs = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            pairs.append((bound, running))
+        return pairs
+
+    def to_dict(self):
+        """A JSON serializable summary of the histogram."""
+        return {
+            'buckets': [
+                ['+Inf' if bound == float('inf') else bound, count] \
+                for bound, count in self.cumulative()
+            ],
+            'sum': self.total,
+            'count': self.count,
+        }
+
+
+class Stats(object):
+    """
+    Process wide registry of the stage timers, counters and histograms of a
+    run.
+    """
+
+    prefix = 'scrapop'
+
+    _lock = threading.Lock()
+    _stages = OrderedDict()
+    _counters = OrderedDict()
+    _histograms = OrderedDict()
+    _started = time.time()
+
+    @classmethod
+    def reset(cls):
+        """Forget everything recorded so far."""
+        with cls._lock:
+            cls._stages.clear()
+            cls._counters.clear()
+            cls._histograms.clear()
+            cls._started = time.time()
+
+    @classmethod
+    def incr(cls, name, amount=1):
+        """Increase a counter."""
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + amount
+
+    @classmethod
+    def observe(cls, name, value, buckets=None):
+        """Record a value in a histogram, created with buckets on first use."""
+        with cls._lock:
+            if name not in cls._histograms:
+                cls._histograms[name] = Histogram(buckets)
+            cls._histograms[name].observe(value)
+
+    @classmethod
+    def add_time(cls, stage, seconds):
+        """Add to the time spent in a stage."""
+        with cls._lock:
+            cls._stages[stage] = cls._stages.get(stage, 0.0) + seconds
+
+    @classmethod
+    @contextmanager
+    def stage(cls, stage):
+        """Time the body of a with statement as part of a stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.add_time(stage, time.time() - start)
+
+    @classmethod
+    def get_counter(cls, name):
+        """Get the value of a counter."""
+        return cls._counters.get(name, 0)
+
+    @classmethod
+    def to_dict(cls):
+        """A JSON serializable snapshot of everything recorded."""
+        with cls._lock:
+            return {
+                'started': cls._started,
+                'elapsed': time.time() - cls._started,
+                'stages': OrderedDict(cls._stages),
+                'counters': OrderedDict(cls._counters),
+                'histograms': OrderedDict(
+                    (name, histogram.to_dict()) for name, histogram in cls._histograms.items()
+                ),
+            }
+
+    @classmethod
+    def metric_name(cls, name):
+        """Sanitize a name for use as a Prometheus metric name."""
+        return re.sub(r'[^a-zA-Z0-9_]', '_', '%s_%s' % (cls.prefix, name))
+
+    @classmethod
+    def format_prometheus(cls):
+        """Render everything recorded in the Prometheus text exposition format."""
+        snapshot = cls.to_dict()
+        lines = []
+
+        name = cls.metric_name('stage_seconds')
+        lines.append('# TYPE %s gauge' % name)
+        for stage, seconds in snapshot['stages'].items():
+            lines.append('%s{stage="%s"} %r' % (name, stage, seconds))
+
+        for counter, value in snapshot['counters'].items():
+            name = cls.metric_name(counter + '_total')
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %r' % (name, value))
+
+        with cls._lock:
+            histograms = [
+                (histogram_name, histogram.cumulative(), histogram.total, histogram.count) \
+                for histogram_name, histogram in cls._histograms.items()
+            ]
+        for histogram_name, cumulative, total, count in histograms:
+            name = cls.metric_name(histogram_name)
+            lines.append('# TYPE %s histogram' % name)
+            for bound, bucket_count in cumulative:
+                lines.append('%s_bucket{le="%s"} %d' % (
+                    name, '+Inf' if bound == float('inf') else repr(bound), bucket_count
+                ))
+            lines.append('%s_sum %r' % (name, total))
+            lines.append('%s_count %d' % (name, count))
+
+        name = cls.metric_name('run_elapsed_seconds')
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %r' % (name, snapshot['elapsed']))
+        name = cls.metric_name('last_run_timestamp_seconds')
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %r' % (name, snapshot['started']))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def _write_atomic(cls, path, contents):
+        """Write a file such that readers never see it half written."""
+        path = os.path.expanduser(path)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as stats_handle:
+            stats_handle.write(contents)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def write_json(cls, path):
+        """Export everything recorded as JSON."""
+        cls._write_atomic(path, json.dumps(cls.to_dict(), indent=2))
+
+    @classmethod
+    def write_prometheus(cls, path):
+        """Export everything recorded as a node exporter textfile."""
+        cls._write_atomic(path, cls.format_prometheus())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Pacing of requests to rate limited APIs.
+"""
+
+from __future__ import print_function
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket rate limiter.
+
+    Tokens accumulate at `rate` per second up to `burst`, each request
+    consumes one token and blocks until one is available.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): Sustained number of requests per second.
+            burst (int): Number of requests that can be made back to back
+                after a quiet period.
+        """
+        if rate <= 0:
+            raise UserWarning('rate limit must be positive, not %s' % rate)
+        self.rate = float(rate)
+        self.burst = float(max(1, burst or 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` tokens are available and consume them.
+
+        Returns:
+            float: The number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveBatcher(object):
+    """
+    Chooses how many domains to send per request from observed responses.
+
+    The batch size grows by one after each fast, successful request and is
+    halved after a slow or failed one, staying between `minimum` and
+    `maximum`.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, target_latency=2.0):
+        """
+        Args:
+            maximum (int): Largest batch size, usually the API's per call limit.
+            minimum (int): Smallest batch size.
+            initial (int): Starting batch size, defaults to maximum.
+            target_latency (float): Requests slower than this many seconds
+                shrink the batch size.
+        """
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        if initial is None:
+            initial = self.maximum
+        self.size = max(self.minimum, min(initial, self.maximum))
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def record(self, latency, error=False):
+        """
+        Adjust the batch size given the outcome of a request.
+
+        Args:
+            latency (float): Seconds taken by the request.
+            error (bool): Whether the request failed.
+        """
+        with self.lock:
+            if error or (self.target_latency and latency > self.target_latency):
+                self.size = max(self.minimum, self.size // 2)
+            else:
+                self.size = min(self.maximum, self.size + 1)
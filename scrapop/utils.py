@@ -4,23 +4,24 @@ Utilities for Scrapop module.
 """
 
 from __future__ import print_function
+import argparse
 import time
 import datetime
+from collections import OrderedDict
+import json
 import os
 import re
+import threading
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from numbers import Number
 from urlparse import urlsplit, urlunsplit
 
-import httplib2
-from apiclient import discovery
-from oauth2client import client as oauth2_client
-from oauth2client import tools
-from oauth2client.file import Storage
-import tldextract
-from awis import AwisApi
-#pylint: disable=no-name-in-module
-from lxml.etree import tostring as etree_tostring
-from lxml.etree import ElementTree
+from scrapop.stats import Stats
+
+# httplib2, apiclient, oauth2client, tldextract, awis and lxml are slow to
+# import, so they are imported where they are first needed. Short runs and
+# --help don't pay for the ones they don't use.
 
 
 class SanitationUtils(object):
@@ -43,6 +44,13 @@ class SanitationUtils(object):
 
 
 
+    error_empty_cell = 'empty cell'
+    error_no_domain = 'could not extract domain'
+
+    _hyperlink_prefix = '=HYPERLINK('
+    _hyperlink_pattern = re.compile(re_gss_hyperlink)
+    _alexa_siteinfo_pattern = re.compile(re_alexa_siteinfo_url)
+
     @classmethod
     def extract_target_gss_cell(cls, cell):
         """
@@ -50,30 +58,86 @@ class SanitationUtils(object):
         """
         if not cell:
             return
-        target_match = re.match(cls.re_gss_hyperlink, cell)
-        if target_match:
-            href = target_match.groupdict().get('href')
-            href_match = re.match(cls.re_alexa_siteinfo_url, href)
-            if href_match:
-                domain = href_match.groupdict().get('domain')
-                return domain
+        domains, _, _ = cls.extract_target_gss_cells([cell], track_unique=False)
+        return domains[0]
+
+    @classmethod
+    def extract_target_gss_cells(cls, cells, unique_domains=None, track_unique=True):
+        """
+        Extract the target domains from a batch of google sheet cells.
+
+        Args:
+            cells (list): The cell values.
+            unique_domains (OrderedDict): Lowercase domains seen so far, which
+                newly found domains are added to, for extracting a column in
+                several batches.
+            track_unique (bool): Whether to collect the unique domains, which
+                callers that dedupe the domains themselves can skip.
+
+        Returns:
+            tuple: the lowercase domain (or None) of each cell, the error code
+                (or None) of each cell, and the unique domains in the order
+                they were first seen (None if not tracked).
+        """
+        if not track_unique:
+            unique_domains = None
+        elif unique_domains is None:
+            unique_domains = OrderedDict()
+        hyperlink_match = cls._hyperlink_pattern.match
+        siteinfo_match = cls._alexa_siteinfo_pattern.match
+        hostname_search = UrlUtils.hostname_token_pattern.search
+        hyperlink_prefix = cls._hyperlink_prefix
+
+        domains = []
+        errors = []
+        for cell in cells:
+            # a falsy value such as 0 is still something in the cell
+            if cell is None or cell == '':
+                domains.append(None)
+                errors.append(cls.error_empty_cell)
+                continue
+            # every way of finding a domain needs a dot somewhere in the cell
+            if not isinstance(cell, basestring) or '.' not in cell:
+                domains.append(None)
+                errors.append(cls.error_no_domain)
+                continue
 
-            text = target_match.groupdict().get('text')
-            for token in text.split():
-                extracted_hostname = UrlUtils.extract_hostname(token)
-                if extracted_hostname:
-                    return extracted_hostname
-        for token in cell.split():
-            extracted_hostname = UrlUtils.extract_hostname(token)
-            if extracted_hostname:
-                return extracted_hostname
+            domain = None
+            if cell.startswith(hyperlink_prefix):
+                target_match = hyperlink_match(cell)
+                if target_match:
+                    href_match = siteinfo_match(target_match.group('href'))
+                    if href_match:
+                        domain = href_match.group('domain')
+                    else:
+                        hostname_match = hostname_search(target_match.group('text'))
+                        if hostname_match:
+                            domain = hostname_match.group(1)
+            if domain is None:
+                hostname_match = hostname_search(cell)
+                if hostname_match:
+                    domain = hostname_match.group(1)
+
+            if domain is None:
+                domains.append(None)
+                errors.append(cls.error_no_domain)
+                continue
+            domain = domain.lower()
+            domains.append(domain)
+            errors.append(None)
+            if unique_domains is not None and domain not in unique_domains:
+                unique_domains[domain] = None
+
+        return domains, errors, unique_domains
 
 class UrlUtils(object):
     """
     A set of general utilities related to parsing URLs.
     """
 
-    re_domain = r'[\w.~-]\.[\w.~-]'
+    re_domain = r'[\w.~-]+\.[\w.~-]+'
+    # re_domain at the start of any whitespace separated token
+    hostname_token_pattern = re.compile(r'(?<!\S)(%s)' % re_domain)
 
     @classmethod
     def extract_hostname(cls, token):
@@ -85,11 +149,45 @@ class UrlUtils(object):
         if match:
             return match.group(0)
 
+    # Location of a pinned public suffix list, None uses the snapshot bundled
+    # with tldextract. The network is never used.
+    suffix_list_file = None
+    domain_cache_size = 100000
+
+    _extractor = None
+    _domain_cache = OrderedDict()
+    _domain_lock = threading.Lock()
+
     @classmethod
-    def only_domain(cls, url):
-        """Extracts only the domain part of the url, excluding the subdomain """
+    def configure_suffix_list(cls, suffix_list_file=None):
+        """Use a different public suffix list for subsequent domain extraction."""
+        with cls._domain_lock:
+            cls.suffix_list_file = suffix_list_file
+            cls._extractor = None
+            cls._domain_cache.clear()
+
+    @classmethod
+    def get_extractor(cls):
+        """Get the offline domain extractor, loading the suffix list once."""
+        with cls._domain_lock:
+            if cls._extractor is None:
+                suffix_list_urls = ()
+                if cls.suffix_list_file:
+                    suffix_list_urls = (
+                        'file://' + os.path.abspath(os.path.expanduser(cls.suffix_list_file)),
+                    )
+                import tldextract
+                cls._extractor = tldextract.TLDExtract(
+                    cache_file=False,
+                    suffix_list_urls=suffix_list_urls,
+                    fallback_to_snapshot=True
+                )
+            return cls._extractor
+
+    @classmethod
+    def _extract_domain(cls, url):
         try:
-            ext = tldextract.extract(url)
+            ext = cls.get_extractor()(url)
         except TypeError as e:
             raise UserWarning("could not extract url {url} because of exception {e} ".format(
                 url=url,
@@ -102,6 +200,32 @@ class UrlUtils(object):
             ] if part
         )
 
+    @classmethod
+    def only_domain(cls, url):
+        """Extracts only the domain part of the url, excluding the subdomain """
+        with cls._domain_lock:
+            if url in cls._domain_cache:
+                domain = cls._domain_cache.pop(url)
+                cls._domain_cache[url] = domain
+                return domain
+        domain = cls._extract_domain(url)
+        with cls._domain_lock:
+            cls._domain_cache[url] = domain
+            if len(cls._domain_cache) > cls.domain_cache_size:
+                cls._domain_cache.popitem(last=False)
+        return domain
+
+    @classmethod
+    def only_domains(cls, urls):
+        """
+        Extracts only the domain part of each url in a list, see only_domain.
+        """
+        domains = {}
+        for url in urls:
+            if url not in domains:
+                domains[url] = cls.only_domain(url)
+        return [domains[url] for url in urls]
+
     @classmethod
     def no_dynamic(cls, url):
         """Removes the fragment, params and query part of the url"""
@@ -239,6 +363,15 @@ class ListUtils(object):
             for sublist in superlist
         ]
 
+    @classmethod
+    def iter_firsts(cls, superlist):
+        """
+        Yield the first item of each sublist in an iterable of sublists.
+        """
+
+        for sublist in superlist:
+            yield sublist[0] if len(sublist) else None
+
     @classmethod
     def unique_true(cls, seq):
         """
@@ -250,8 +383,62 @@ class ListUtils(object):
 class GssUtils(object):
     """
     Utilities related to Google Drive Spreadsheets API.
+
+    Credentials and the discovery document are shared by the whole process,
+    service objects are built once per thread since httplib2.Http is not
+    thread safe.
     """
 
+    credential_dir = os.path.join('~', '.credentials')
+    credential_file = 'sheets.googleapis.com-python-quickstart.json'
+    discovery_url = ('https://sheets.googleapis.com/$discovery/rest?'
+                     'version=v4')
+    discovery_version = 'v4'
+    discovery_file = 'sheets.googleapis.com-v4-discovery.json'
+    # re-fetch the cached discovery document after this many seconds
+    discovery_max_age = 24 * 60 * 60
+    # refresh access tokens this many seconds before they expire
+    token_refresh_margin = 5 * 60
+
+    # keep batchUpdate payloads well under the API's request size limit
+    max_update_bytes = 1024 * 1024
+    max_ranges_per_update = 1000
+    windows_per_request = 2
+
+    _lock = threading.RLock()
+    _local = threading.local()
+    _credentials = None
+    _discovery_doc = None
+
+    @classmethod
+    def get_credential_dir(cls):
+        """Get the directory holding credentials and cached API documents."""
+        credential_dir = os.path.expanduser(cls.credential_dir)
+        if not os.path.exists(credential_dir):
+            os.makedirs(credential_dir)
+        return credential_dir
+
+    @classmethod
+    def get_flags_parser(cls):
+        """
+        Get a parser for the flags tools.run_flow expects, to use as a parent.
+
+        These are the flags of oauth2client.tools.argparser, which is slow to
+        import just to build a command line.
+        """
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('--auth_host_name', default='localhost',
+                            help='Hostname when running a local web server.')
+        parser.add_argument('--noauth_local_webserver', action='store_true',
+                            default=False, help='Do not run a local web server.')
+        parser.add_argument('--auth_host_port', default=[8080, 8090], type=int,
+                            nargs='*', help='Port web server should listen on.')
+        parser.add_argument(
+            '--logging_level', default='ERROR',
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            help='Set the logging level of detail.')
+        return parser
+
     @classmethod
     def get_credentials(cls, options):
         """Gets valid user credentials from storage.
@@ -262,31 +449,124 @@ class GssUtils(object):
         Returns:
             Credentials, the obtained credential.
         """
-        home_dir = os.path.expanduser('~')
-        credential_dir = os.path.join(home_dir, '.credentials')
-        if not os.path.exists(credential_dir):
-            os.makedirs(credential_dir)
-        credential_path = os.path.join(credential_dir,
-                                       'sheets.googleapis.com-python-quickstart.json')
+        with cls._lock:
+            if cls._credentials is not None and not cls._credentials.invalid:
+                return cls._credentials
+
+            from oauth2client import client as oauth2_client
+            from oauth2client import tools
+            from oauth2client.file import Storage
+
+            credential_path = os.path.join(cls.get_credential_dir(), cls.credential_file)
+
+            store = Storage(credential_path)
+            credentials = store.get()
+            if not credentials or credentials.invalid:
+                flow = oauth2_client.flow_from_clientsecrets(
+                    options.client_secret_file, options.scopes
+                )
+                flow.user_agent = options.app_name
+                credentials = tools.run_flow(flow, store, options)
+                print('Storing credentials to ' + credential_path)
+            cls._credentials = credentials
+            return credentials
+
+    @classmethod
+    def use_credentials(cls, credentials):
+        """
+        Use the given credentials instead of those from storage.
+
+        Services already built by this thread are discarded.
+        """
+        with cls._lock:
+            cls._credentials = credentials
+            cls._local.service = None
+
+    @classmethod
+    def refresh_credentials(cls, credentials):
+        """Refresh the access token if it is about to expire."""
+        expiry = getattr(credentials, 'token_expiry', None)
+        if expiry is None:
+            return
+        margin = datetime.timedelta(seconds=cls.token_refresh_margin)
+        if expiry - datetime.datetime.utcnow() < margin:
+            with cls._lock:
+                if credentials.token_expiry - datetime.datetime.utcnow() < margin:
+                    import httplib2
+                    credentials.refresh(httplib2.Http())
+
+    @classmethod
+    def get_discovery_doc(cls, http):
+        """
+        Get the Sheets API discovery document.
 
-        store = Storage(credential_path)
-        credentials = store.get()
-        if not credentials or credentials.invalid:
-            flow = oauth2_client.flow_from_clientsecrets(options.client_secret_file, options.scopes)
-            flow.user_agent = options.app_name
-            credentials = tools.run_flow(flow, store, options)
-            print('Storing credentials to ' + credential_path)
-        return credentials
+        The document is persisted next to the credentials and only re-fetched
+        when it is older than discovery_max_age or for the wrong version. If it
+        can't be re-fetched, a stale copy is used.
+
+        Returns:
+            basestring: the discovery document.
+        """
+        import httplib2
+        with cls._lock:
+            if cls._discovery_doc is not None:
+                return cls._discovery_doc
+
+            discovery_path = os.path.join(cls.get_credential_dir(), cls.discovery_file)
+            cached_doc = None
+            if os.path.exists(discovery_path):
+                with open(discovery_path) as discovery_handle:
+                    cached_doc = discovery_handle.read()
+                try:
+                    cached_version = json.loads(cached_doc).get('version')
+                except ValueError:
+                    cached_doc, cached_version = None, None
+                age = time.time() - os.path.getmtime(discovery_path)
+                if cached_version == cls.discovery_version and age < cls.discovery_max_age:
+                    cls._discovery_doc = cached_doc
+                    return cached_doc
+
+            try:
+                response, content = http.request(cls.discovery_url)
+                if response.status != 200:
+                    raise IOError('could not fetch discovery document, status %d' \
+                        % response.status)
+                if json.loads(content).get('version') != cls.discovery_version:
+                    raise IOError('discovery document is not for version %s' \
+                        % cls.discovery_version)
+            except (IOError, ValueError, httplib2.HttpLib2Error):
+                if cached_doc is None:
+                    raise
+                content = cached_doc
+            else:
+                temp_path = discovery_path + '.tmp'
+                with open(temp_path, 'w') as discovery_handle:
+                    discovery_handle.write(content)
+                os.rename(temp_path, discovery_path)
+
+            cls._discovery_doc = content
+            return content
+
+    @classmethod
+    def get_service(cls, options):
+        """Get the Sheets API service object for the current thread."""
+        credentials = cls.get_credentials(options)
+        service = getattr(cls._local, 'service', None)
+        if service is None:
+            import httplib2
+            from apiclient import discovery
+            http = credentials.authorize(httplib2.Http())
+            service = discovery.build_from_document(
+                cls.get_discovery_doc(http), http=http
+            )
+            cls._local.service = service
+        cls.refresh_credentials(credentials)
+        return service
 
     @classmethod
     def get_range(cls, spreadsheet_id, range_name, value_render, options):
         """Get column from spreadsheet."""
-        credentials = cls.get_credentials(options)
-        http = credentials.authorize(httplib2.Http())
-        discovery_url = ('https://sheets.googleapis.com/$discovery/rest?'
-                         'version=v4')
-        service = discovery.build('sheets', 'v4', http=http,
-                                  discoveryServiceUrl=discovery_url)
+        service = cls.get_service(options)
 
         request_arguments = dict(
             spreadsheetId=spreadsheet_id,
@@ -301,51 +581,429 @@ class GssUtils(object):
 
         return values
 
+    @classmethod
+    def column_index(cls, column):
+        """Convert column letters like 'A' or 'AB' to a zero based index."""
+        index = 0
+        for letter in column.upper():
+            index = index * 26 + ord(letter) - ord('A') + 1
+        return index - 1
+
+    @classmethod
+    def column_letters(cls, index):
+        """Convert a zero based column index to column letters."""
+        letters = ''
+        index += 1
+        while index:
+            index, remainder = divmod(index - 1, 26)
+            letters = chr(ord('A') + remainder) + letters
+        return letters
+
+    @classmethod
+    def execute_read(cls, request):
+        """
+        Execute a Sheets read request, timed in the sheet_read stage.
+
+        Reads run concurrently, so the stage is the sum of their latencies
+        rather than wall time.
+        """
+        start = time.time()
+        try:
+            return request.execute()
+        finally:
+            latency = time.time() - start
+            Stats.add_time('sheet_read', latency)
+            Stats.observe('sheets_read_latency_seconds', latency)
+
+    @classmethod
+    def get_ranges(cls, spreadsheet_id, range_names, value_render, options):
+        """Get several ranges from spreadsheet in one request."""
+        service = cls.get_service(options)
+
+        request_arguments = dict(
+            spreadsheetId=spreadsheet_id,
+            ranges=range_names,
+        )
+        if value_render:
+            request_arguments.update(valueRenderOption=value_render)
+
+        #pylint: disable=no-member
+        request = service.spreadsheets().values().batchGet(**request_arguments)
+        result = cls.execute_read(request)
+        Stats.incr('sheets_read_requests')
+        return [
+            value_range.get('values', []) \
+            for value_range in result.get('valueRanges', [])
+        ]
+
+    @classmethod
+    def get_row_count(cls, spreadsheet_id, sheet, options):
+        """Get the number of rows in the grid of a sheet."""
+        service = cls.get_service(options)
+        #pylint: disable=no-member
+        result = cls.execute_read(service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            ranges=["'%s'" % sheet],
+            fields='sheets.properties.gridProperties.rowCount'
+        ))
+        for sheet_info in result.get('sheets', []):
+            return sheet_info['properties']['gridProperties']['rowCount']
+        return 0
+
+    @classmethod
+    def iter_column(cls, spreadsheet_id, sheet, column, value_render, options,
+                    window=5000, concurrency=1):
+        """
+        Yield the rows of a column, reading it a window of rows at a time.
+
+        Windows are requested windows_per_request at a time with batchGet,
+        with up to `concurrency` requests in flight. Rows are yielded in order
+        as soon as their window arrives, and iteration stops at the last
+        non-empty row.
+        """
+        row_count = cls.get_row_count(spreadsheet_id, sheet, options)
+        window_ranges = [
+            "'{sheet}'!{col}{start}:{col}{end}".format(
+                sheet=sheet,
+                col=column,
+                start=start,
+                end=min(start + window - 1, row_count),
+            ) for start in range(1, row_count + 1, window)
+        ]
+        groups = [
+            window_ranges[index:index + cls.windows_per_request] \
+            for index in range(0, len(window_ranges), cls.windows_per_request)
+        ]
+
+        def get_group(range_names):
+            """Read a group of windows."""
+            return cls.get_ranges(spreadsheet_id, range_names, value_render, options)
+
+        pool = None
+        if concurrency > 1 and len(groups) > 1:
+            pool = ThreadPool(concurrency)
+            results = pool.imap(get_group, groups)
+        else:
+            results = (get_group(group) for group in groups)
+
+        try:
+            empty_rows = 0
+            for windows in results:
+                for window_rows in windows:
+                    # the API leaves out trailing empty rows of each window
+                    window_rows = window_rows + [[]] * (window - len(window_rows))
+                    for row in window_rows:
+                        if all(value in ('', None) for value in row):
+                            empty_rows += 1
+                            continue
+                        for _ in range(empty_rows):
+                            yield []
+                        empty_rows = 0
+                        yield row
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    @classmethod
+    def batch_update(cls, spreadsheet_id, data, options, value_input='RAW'):
+        """
+        Write a list of value ranges, split into requests under the API limits.
+
+        Args:
+            data (list): dicts with the 'range' and 'values' to write.
+
+        Returns:
+            int: The number of requests made.
+        """
+        service = cls.get_service(options)
+        requests = 0
+        batch, batch_bytes = [], 0
+        for value_range in data + [None]:
+            if value_range is not None:
+                range_bytes = len(json.dumps(value_range))
+            if batch and (
+                    value_range is None
+                    or len(batch) >= cls.max_ranges_per_update
+                    or batch_bytes + range_bytes > cls.max_update_bytes
+            ):
+                body = {
+                    'valueInputOption': value_input,
+                    'data': batch,
+                }
+                #pylint: disable=no-member
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id, body=body
+                ).execute()
+                Stats.incr('sheets_write_requests')
+                requests += 1
+                batch, batch_bytes = [], 0
+            if value_range is not None:
+                batch.append(value_range)
+                batch_bytes += range_bytes
+        return requests
+
+    @classmethod
+    def cell_equal(cls, current, desired):
+        """Determine if a cell's current value is the same as the desired value."""
+        if isinstance(current, Number) and isinstance(desired, Number):
+            return current == desired
+        if current is None:
+            current = ''
+        if desired is None:
+            desired = ''
+        return unicode(current) == unicode(desired)
+
+    @classmethod
+    def diff_ranges(cls, sheet, first_column, rows, current_rows, first_row):
+        """
+        Find the blocks of cells in rows that differ from current_rows.
+
+        Args:
+            sheet (basestring): The name of the sheet.
+            first_column (int): Index of the column the row values start at.
+            rows (dict): Mapping of row number to the list of values to write,
+                None values are left untouched.
+            current_rows (list): The current values of the block starting at
+                first_row.
+            first_row (int): The row number of current_rows[0].
+
+        Returns:
+            list: value ranges, with contiguous changes in a row grouped into
+                one range, and identical spans in consecutive rows merged.
+        """
+        runs = []
+        for row in sorted(rows):
+            offset = row - first_row
+            current = current_rows[offset] if offset < len(current_rows) else []
+            start = None
+            values = rows[row]
+            for index, value in enumerate(values + [None]):
+                existing = current[index] if index < len(current) else None
+                changed = value is not None and not cls.cell_equal(existing, value)
+                if changed and start is None:
+                    start = index
+                elif not changed and start is not None:
+                    runs.append((row, start, values[start:index]))
+                    start = None
+
+        data = []
+        block = None
+        for row, start, values in runs:
+            if block and block['end_row'] == row - 1 and block['start'] == start \
+                    and len(block['values'][0]) == len(values):
+                block['values'].append(values)
+                block['end_row'] = row
+                continue
+            block = {'start_row': row, 'end_row': row, 'start': start, 'values': [values]}
+            data.append(block)
+
+        return [
+            {
+                'range': "'{sheet}'!{start}{start_row}:{end}{end_row}".format(
+                    sheet=sheet,
+                    start=cls.column_letters(first_column + block['start']),
+                    end=cls.column_letters(
+                        first_column + block['start'] + len(block['values'][0]) - 1
+                    ),
+                    start_row=block['start_row'],
+                    end_row=block['end_row'],
+                ),
+                'values': block['values'],
+            } for block in data
+        ]
+
+    @classmethod
+    def update_rows(cls, spreadsheet_id, sheet, first_column, rows, options):
+        """
+        Write values into rows of a sheet, sending only the cells that changed.
+
+        Args:
+            first_column (basestring): Letters of the column values start at.
+            rows (dict): Mapping of row number to the list of values to write.
+
+        Returns:
+            int: The number of cells written.
+        """
+        if not rows:
+            return 0
+        column = cls.column_index(first_column)
+        width = max(len(values) for values in rows.values())
+        first_row, last_row = min(rows), max(rows)
+        current_rows = cls.get_range(
+            spreadsheet_id,
+            "'{sheet}'!{start}{first_row}:{end}{last_row}".format(
+                sheet=sheet,
+                start=first_column,
+                end=cls.column_letters(column + width - 1),
+                first_row=first_row,
+                last_row=last_row,
+            ),
+            value_render='UNFORMATTED_VALUE',
+            options=options
+        )
+        data = cls.diff_ranges(sheet, column, rows, current_rows, first_row)
+        if data:
+            cls.batch_update(spreadsheet_id, data, options)
+        return sum(len(values) for value_range in data for values in value_range['values'])
+
+class AwisError(UserWarning):
+    """
+    Raised when AWIS responds without the requested metrics.
+    """
+
+class AwisAuthError(UserWarning):
+    """
+    Raised when AWIS rejects the credentials or signature of a request, which
+    no amount of retrying or splitting the request will fix.
+    """
+
 class AwisUtils(object):
     """
     Utilities related to AWIS API.
     """
 
+    # AwisApi.MAX_BATCH_REQUESTS, without importing awis
+    max_batch_size = 5
+    _client = None
+
+    @classmethod
+    def configure(cls, key_id, secret_key, host=None):
+        """
+        Set up the client shared by all subsequent AWIS requests.
+        """
+        from scrapop.awis_client import AwisClient
+        cls._client = AwisClient(key_id, secret_key, host=host)
+        return cls._client
+
+    @classmethod
+    def get_client(cls):
+        """Get the shared AWIS client."""
+        if cls._client is None:
+            raise UserWarning('AWIS client is not configured, call AwisUtils.configure first')
+        return cls._client
+
+    @classmethod
+    def cast_metric(cls, text):
+        """
+        Convert the text of a metric element to a number where possible.
+        """
+        for cast in (int, float):
+            try:
+                return cast(text)
+            except (TypeError, ValueError):
+                pass
+        return text
+
+    @classmethod
+    def element_value(cls, elem):
+        """
+        Get the first non-blank text within an element.
+
+        Metrics like Speed wrap their values in child elements, so the text of
+        the element itself is blank.
+        """
+        for descendant in elem.iter():
+            if descendant.text and descendant.text.strip():
+                return cls.cast_metric(descendant.text.strip())
+
     @classmethod
-    def get_metrics(cls, domains, metrics, options):
-        awis_client = AwisApi(options.key_id, options.secret_key)
+    def parse_url_info(cls, source, domains, metrics):
+        """
+        Extract metrics for each domain from a UrlInfo response in a single pass.
 
-        tree = awis_client.url_info(domains, *metrics)
+        Args:
+            source (file): File-like object containing the UrlInfo response.
+            domains (list): The domains in the order they were requested.
+            metrics (list): The names of the metrics to extract.
 
-        alexa_prefix = awis_client.NS_PREFIXES['alexa']
-        awis_prefix = awis_client.NS_PREFIXES['awis']
+        Returns:
+            list: a dict of metric name to value for each domain.
+        """
+        from awis import AwisApi
+        #pylint: disable=no-name-in-module
+        from lxml.etree import iterparse, XMLSyntaxError
 
-        elem = tree.find('//{%s}StatusCode' % alexa_prefix)
-        if elem.text != 'Success':
-            raise UserWarning('unable to get metrics: %s' % etree_tostring(tree))
+        awis_ns = '{%s}' % AwisApi.NS_PREFIXES['awis']
+        alexa_ns = '{%s}' % AwisApi.NS_PREFIXES['alexa']
+        result_tag = awis_ns + 'UrlInfoResult'
+        url_tag = awis_ns + 'DataUrl'
+        status_tag = alexa_ns + 'StatusCode'
+        metric_tags = dict((awis_ns + metric, metric) for metric in metrics)
 
         metric_values = []
-        elems_results = enumerate(tree.findall('//{%s}UrlInfoResult' % awis_prefix))
-        for result_count, elem_result in elems_results:
-            # print("UrlInfoResult Elem: %s" % etree_tostring(elem_result))
-            # print("elem_result tag: %s, text: %s" % (elem_result.tag, elem_result.text))
-            tree_result = ElementTree(elem_result)
-            domain = None
-            elem_url = tree_result.find('//{%s}DataUrl' % awis_prefix)
-            if elem_url is not None:
-                # print("elem_url tag: %s, text: %s" % (elem_url.tag, elem_url.text))
-                domain = elem_url.text
-                if domain[-1] == "/":
-                    domain = domain[:-1]
-
-            assert domain == domains[result_count], \
-                "sanity check %s == %s" % (domain, domains[result_count])
-            # if domain:
-                # print("getting results for domain %s" % domain)
-
-            domain_metrics = {}
-            for metric in metrics:
-                elem_metric = tree_result.find('//{%s}%s' % (awis_prefix, metric))
-                if elem_metric is None:
-                    raise UserWarning('unable to find metric within UrlInfoResult: %s' \
-                        % etree_tostring(tree_result))
-                domain_metrics[metric] = elem_metric.text
-            metric_values.append(domain_metrics)
+        domain = None
+        domain_metrics = None
+        events = iterparse(
+            source,
+            events=('start', 'end'),
+            tag=[result_tag, url_tag, status_tag] + metric_tags.keys()
+        )
+        try:
+            for event, elem in events:
+                if elem.tag == result_tag:
+                    if event == 'start':
+                        domain, domain_metrics = None, {}
+                        continue
+                    result_count = len(metric_values)
+                    if result_count >= len(domains) or domain != domains[result_count]:
+                        raise AwisError("sanity check %s == %s" % (
+                            domain, domains[result_count] if result_count < len(domains) else None
+                        ))
+                    missing = [metric for metric in metrics if metric not in domain_metrics]
+                    if missing:
+                        raise AwisError('unable to find metrics %s within UrlInfoResult for %s' \
+                            % (missing, domain))
+                    metric_values.append(domain_metrics)
+                    domain_metrics = None
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+                elif event != 'end':
+                    continue
+                elif elem.tag == status_tag:
+                    if elem.text != 'Success':
+                        raise AwisError('unable to get metrics: status %s' % elem.text)
+                elif domain_metrics is None:
+                    continue
+                elif elem.tag == url_tag:
+                    if domain is None and elem.text:
+                        domain = elem.text.rstrip('/')
+                else:
+                    metric = metric_tags[elem.tag]
+                    if metric not in domain_metrics:
+                        domain_metrics[metric] = cls.element_value(elem)
+        except XMLSyntaxError as exc:
+            raise AwisError('unable to parse UrlInfo response: %s' % exc)
+
+        if len(metric_values) != len(domains):
+            raise AwisError('expected %d UrlInfoResults, got %d' % (
+                len(domains), len(metric_values)
+            ))
+        return metric_values
+
+    @classmethod
+    def get_metrics(cls, domains, metrics, client=None):
+        """
+        Get metrics for a batch of domains.
+
+        Args:
+            domains (list): The domains to request, at most max_batch_size.
+            metrics (list): The names of the metrics to request.
+            client (AwisApi): The client to use instead of the shared client.
+
+        Returns:
+            list: a dict of metric name to value for each domain.
+        """
+        awis_client = client or cls.get_client()
+
+        response = awis_client.url_info(domains, *metrics, as_xml=False)
+        start = time.time()
+        try:
+            metric_values = cls.parse_url_info(BytesIO(response), domains, metrics)
+        finally:
+            Stats.observe('awis_parse_seconds', time.time() - start,
+                          buckets=(0.0001, 0.001, 0.01, 0.1, 1.0))
 
         print("success: %s" % metric_values)
         return metric_values